@@ -17,9 +17,21 @@ from tensorflow.keras.optimizers.schedules import ExponentialDecay
 from tensorflow.keras.optimizers.schedules import InverseTimeDecay
 from tensorflow.keras.optimizers.schedules import PiecewiseConstantDecay
 from tensorflow.keras.optimizers.schedules import PolynomialDecay
-from utils.exploration import PER_buffer
+from utils.exploration import PER_buffer, ReplayBuffer
 import pdb
 
+# numpy counterparts of the activations used by the Deep Q Network, for the
+# inference path that does not go through the Keras dispatch
+NUMPY_ACTIVATIONS = {
+    "leaky_relu": lambda z: np.where(z > 0, z, 0.2 * z),
+    "relu6": lambda z: np.clip(z, 0.0, 6.0),
+    "elu": lambda z: np.where(z > 0, z, np.expm1(np.minimum(z, 0.0))),
+    "relu": lambda z: np.maximum(z, 0.0),
+    "tanh": np.tanh,
+    "sigmoid": lambda z: 1.0 / (1.0 + np.exp(-z)),
+    "linear": lambda z: z,
+}
+
 ################################ Class to create a Deep Q Network model ################################
 class DeepNetworkModel(tf.keras.Model):
     def __init__(
@@ -70,7 +82,8 @@ class DeepNetworkModel(tf.keras.Model):
 
         """
         # call the parent constructor
-        super(DeepNetworkModel, self).__init__(name=modelname)
+        # spaces are not valid in the name scopes of the compiled training step
+        super(DeepNetworkModel, self).__init__(name=modelname.replace(" ", "_"))
 
         # set dimensionality of input/output depending on the model
         inp_shape = input_shape
@@ -80,6 +93,9 @@ class DeepNetworkModel(tf.keras.Model):
         # set flag for batch norm as attribute
         self.bnflag_input = batch_norm_input
         self.batch_norm_hidden = batch_norm_hidden
+        self.activation = activation
+        # numpy copy of the weights used by fast_call, exported lazily
+        self._numpy_layers = None
         # In setting input_shape, the batch dimension is not included.
         # input layer
         self.input_layer = InputLayer(input_shape=inp_shape)
@@ -147,6 +163,86 @@ class DeepNetworkModel(tf.keras.Model):
         z = self.output_layer(z)
         return z
 
+    def fast_call(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        Inference-only forward pass in numpy with cached weights. It is
+        equivalent to call with training=False, but it avoids the overhead of
+        the Keras dispatch when acting on a single state at a time.
+
+        Parameters
+        ----------
+
+        inputs: np.ndarray
+            Inputs to the neural network
+
+        Returns
+        ----------
+        z: np.ndarray
+            Outputs of the neural network after a forward pass
+
+        """
+        z = np.atleast_2d(inputs).astype("float32")
+        if not self.built:
+            return self.call(z, training=False).numpy()
+        if self._numpy_layers is None:
+            self._export_weights()
+        for kind, params in self._numpy_layers:
+            if kind == "dense":
+                z = z @ params[0] + params[1]
+            elif kind == "batch":
+                z = z * params[0] + params[1]
+            elif kind == "activation":
+                z = params(z)
+        return z
+
+    def reset_fast_call(self):
+        """
+        Invalidate the numpy weights used by fast_call. It has to be called
+        every time the weights of the model are changed
+        """
+        self._numpy_layers = None
+
+    def load_weights(self, *args, **kwargs):
+        self.reset_fast_call()
+        return super(DeepNetworkModel, self).load_weights(*args, **kwargs)
+
+    def set_weights(self, *args, **kwargs):
+        self.reset_fast_call()
+        return super(DeepNetworkModel, self).set_weights(*args, **kwargs)
+
+    # PRIVATE METHODS
+    def _export_weights(self):
+        layers = []
+        if self.bnflag_input:
+            layers.append(("batch", self._batch_norm_params(self.bnorm_layer)))
+        for layer in self.hids:
+            if isinstance(layer, Dense):
+                kernel, bias = layer.get_weights()
+                layers.append(("dense", (kernel, bias)))
+            elif isinstance(layer, BatchNormalization):
+                layers.append(("batch", self._batch_norm_params(layer)))
+            elif self.activation in NUMPY_ACTIVATIONS:
+                layers.append(("activation", NUMPY_ACTIVATIONS[self.activation]))
+            else:
+                # activations without a numpy counterpart go through TF
+                layers.append(
+                    ("activation", lambda z, layer=layer: layer(z).numpy())
+                )
+        kernel, bias = self.output_layer.get_weights()
+        layers.append(("dense", (kernel, bias)))
+        self._numpy_layers = layers
+
+    @staticmethod
+    def _batch_norm_params(layer: BatchNormalization) -> Tuple[np.ndarray]:
+        # fold the moving statistics into a single affine transformation
+        scale = 1.0 / np.sqrt(layer.moving_variance.numpy() + layer.epsilon)
+        if layer.scale:
+            scale = scale * layer.gamma.numpy()
+        shift = -layer.moving_mean.numpy() * scale
+        if layer.center:
+            shift = shift + layer.beta.numpy()
+        return scale.astype("float32"), shift.astype("float32")
+
 
 ############################### DQN ALGORITHM ################################
 @gin.configurable()
@@ -196,6 +292,7 @@ class DQN:
         rng=None,
         N_train: int = 100000,
         modelname: str = "Deep Network",
+        jit_compile: bool = False,
     ):
         """
         Instantiate DQN Class
@@ -349,6 +446,10 @@ class DQN:
         modelname: str
             Name for the model
 
+        jit_compile: bool = False
+            Boolean to regulate if the compiled training step is also compiled
+            with XLA
+
         """
 
         if rng is not None:
@@ -419,7 +520,7 @@ class DQN:
                 sample_type,
             )  # experience is stored as object of this class
         else:
-            self.experience = {"s": [], "a": [], "r": [], "s2": [], "a_unsc": []}
+            self.memory = ReplayBuffer(self.max_experiences, self.rng)
 
         self.start_train = start_train
         self.action_space = action_space
@@ -467,6 +568,9 @@ class DQN:
         self.min_eps = min_eps
         self.min_eps_pct = min_eps_pct
 
+        # graph-compiled training step, traced once for the minibatch shapes
+        self._train_step = tf.function(self._train_step, jit_compile=jit_compile)
+
     def train(
         self,
         iteration: int,
@@ -490,86 +594,116 @@ class DQN:
 
         if self.use_PER:
             b_idx, minibatch = self.PERmemory.sample_batch(self.batch_size)
-            states = np.asarray(minibatch["s"])
-            actions = np.asarray(minibatch["a"])
-            rewards = np.asarray(minibatch["r"])
-            states_next = np.asarray(minibatch["s2"])
-
-        else:
-            # find the index of streams included in the experience buffer that will
-            # composed the training batch
-            ids = self.rng.randint(
-                low=0, high=len(self.experience["s"]), size=self.batch_size
+            # compute weights
+            if iteration < self.max_experiences:
+                N = iteration + 1
+            else:
+                N = self.max_experiences
+            self.PERmemory.PER_b = min(
+                self.PERmemory.final_PER_b,
+                self.PERmemory.PER_b + self.PERmemory.PER_b_growth,
             )
+            priorities = self.PERmemory.tree[b_idx] / self.PERmemory.total_priority
+            PER_params = (N, self.PERmemory.PER_b)
+        else:
+            # sample uniformly the experiences that will compose the training batch
+            minibatch = self.memory.sample_batch(self.batch_size)
+            priorities = np.ones(self.batch_size)
+            PER_params = (1.0, 0.0)
+
+        # build the networks eagerly, so that their initialization does not
+        # depend on the tracing of the compiled training step
+        if not self.model.built:
+            self.model(minibatch["s"].astype("float32"), training=False)
+        if not self.target_model.built:
+            self.target_model(minibatch["s2"].astype("float32"), training=False)
+
+        # experiences are stored as float32 and actions as indices of the action space
+        td_errors = self._train_step(
+            tf.convert_to_tensor(minibatch["s"], dtype=tf.float32),
+            tf.convert_to_tensor(minibatch["a"], dtype=tf.int32),
+            tf.convert_to_tensor(minibatch["r"], dtype=tf.float32),
+            tf.convert_to_tensor(minibatch["s2"], dtype=tf.float32),
+            tf.convert_to_tensor(priorities, dtype=tf.float32),
+            tf.constant(PER_params, dtype=tf.float32),
+        )
+        # the weights used for acting are refreshed at the next action
+        self.model.reset_fast_call()
+
+        if self.use_PER:
+            # update priorities
+            if self.PERmemory.sample_type == "rewards":
+                self.PERmemory.batch_update(b_idx, np.abs(minibatch["r"]))
+            elif (
+                self.PERmemory.sample_type == "TDerror"
+                or self.PERmemory.sample_type == "diffTDerror"
+            ):
+                self.PERmemory.batch_update(b_idx, td_errors.numpy())
+            else:
+                print("Sample type for PER not available")
+                sys.exit()
+
+    def _train_step(
+        self,
+        states: tf.Tensor,
+        actions: tf.Tensor,
+        rewards: tf.Tensor,
+        states_next: tf.Tensor,
+        priorities: tf.Tensor,
+        PER_params: tf.Tensor,
+    ) -> tf.Tensor:
+        """Parameters
+        ----------
+        states: tf.Tensor
+            Batch of current states
+
+        actions: tf.Tensor
+            Batch of indices of the actions taken
 
-            states = np.asarray([self.experience["s"][i] for i in ids])
-            actions = np.asarray([self.experience["a"][i] for i in ids])
-            rewards = np.asarray([self.experience["r"][i] for i in ids])
-            states_next = np.asarray([self.experience["s2"][i] for i in ids])
+        rewards: tf.Tensor
+            Batch of rewards
 
+        states_next: tf.Tensor
+            Batch of next states
+
+        priorities: tf.Tensor
+            Sampling probabilities of the experiences when using PER
+
+        PER_params: tf.Tensor
+            Number of stored experiences and amount of correction b when using PER
+
+        Returns
+        ----------
+        td_errors: tf.Tensor
+            Absolute TD errors of the batch, used as new priorities by PER
+        """
         with tf.GradientTape() as tape:
 
             # compute current action values
-            # find index of actions included in the batch
-            encoded_actions = [
-                self.action_space.values.tolist().index(act) for act in actions
-            ]
-            selected_action_values = tf.math.reduce_sum(
-                self.model(np.atleast_2d(states.astype("float32")),)
-                * tf.one_hot(encoded_actions, self.num_actions),
-                axis=1,
+            selected_action_values = tf.gather(
+                self.model(states), actions, batch_dims=1
             )
 
             # compute target action values
             if self.DQN_type == "DQN":
-                value_next = np.max(
-                    self.target_model(states_next.astype("float32")), axis=1
-                )
+                value_next = tf.math.reduce_max(self.target_model(states_next), axis=1)
             elif self.DQN_type == "DDQN":
-                greedy_target_action = tf.math.argmax(
-                    self.model(states_next.astype("float32")), 1
-                )
-                value_next = tf.math.reduce_sum(
-                    self.target_model(states_next.astype("float32"))
-                    * tf.one_hot(greedy_target_action, self.num_actions),
-                    axis=1,
+                greedy_target_action = tf.math.argmax(self.model(states_next), 1)
+                value_next = tf.gather(
+                    self.target_model(states_next), greedy_target_action, batch_dims=1
                 )
 
             actual_values = rewards + self.gamma * value_next
 
             if self.use_PER:
-                # compute weights
-                if iteration < self.max_experiences:
-                    N = iteration + 1
-                else:
-                    N = self.max_experiences
-                prob = self.PERmemory.tree[b_idx] / self.PERmemory.total_priority
-                self.PERmemory.PER_b = min(
-                    self.PERmemory.final_PER_b,
-                    self.PERmemory.PER_b + self.PERmemory.PER_b_growth,
-                )
-                w_IS = (N * prob) ** (-self.PERmemory.PER_b)
-                scaled_w_IS = w_IS / np.max(w_IS)
-
-                # update priorities
-                if self.PERmemory.sample_type == "rewards":
-                    self.PERmemory.batch_update(b_idx, np.abs(rewards))
-                elif (
-                    self.PERmemory.sample_type == "TDerror"
-                    or self.PERmemory.sample_type == "diffTDerror"
-                ):
-                    self.PERmemory.batch_update(
-                        b_idx, np.abs(actual_values - selected_action_values)
-                    )
-                else:
-                    print("Sample type for PER not available")
-                    sys.exit()
+                w_IS = (PER_params[0] * priorities) ** (-PER_params[1])
+                scaled_w_IS = w_IS / tf.math.reduce_max(w_IS)
 
                 # compute loss function for the train model
                 loss = self.loss(
                     y_true=actual_values,
                     y_pred=selected_action_values,
-                    sample_weight=scaled_w_IS.reshape(-1, 1),
+                    sample_weight=tf.reshape(scaled_w_IS, (-1, 1)),
                 )
 
             else:
@@ -584,9 +718,11 @@ class DQN:
         # provide a list of (gradient, variable) pairs.
         self.optimizer.apply_gradients(zip(gradients, variables))
 
+        return tf.math.abs(actual_values - selected_action_values)
+
     def eps_greedy_action(
         self, states: np.ndarray, epsilon: float, side_only: bool = False
-    ) -> Tuple[Union[float or int], np.ndarray]:
+    ) -> Tuple[int, np.ndarray]:
         """Parameters
         ----------
         states: np.ndarray
@@ -600,38 +736,31 @@ class DQN:
 
         Returns
         ----------
-        action: Union[float or int]
-            Epsilon greedy selected action
+        action: int
+            Index in the action space of the epsilon greedy selected action
         qvalues : np.ndarray
             Q values associated to the actions space
         """
         if not side_only:
             if self.rng.random() < epsilon:
-                action = self.rng.choice(self.action_space.values)
+                action = self.rng.randint(self.num_actions)
                 return action, None
             else:
-                action = self.action_space.values[
-                    np.argmax(
-                        self.model(
-                            np.atleast_2d(states.astype("float32")), training=False
-                        )[0]
-                    )
-                ]
+                qvalues = self.model.fast_call(states)
+                action = np.argmax(qvalues[0])
                 return action, None
         else:
             if self.rng.random() < epsilon:
-                action = self.rng.choice(self.action_space.values)
+                action = self.rng.randint(self.num_actions)
                 return action, None
             else:
-                qvalues = self.model(
-                    np.atleast_2d(states.astype("float32")), training=False
-                )
-                action = self.action_space.values[np.argmax(qvalues[0])]
+                qvalues = self.model.fast_call(states)
+                action = np.argmax(qvalues[0])
                 return action, qvalues
 
     def greedy_action(
         self, states: np.ndarray, side_only: bool = False
-    ) -> Tuple[Union[float or int], np.ndarray]:
+    ) -> Tuple[int, np.ndarray]:
         """Parameters
         ----------
         states: np.ndarray
@@ -642,42 +771,36 @@ class DQN:
 
         Returns
         ----------
-        action: Union[float or int]
-            Greedy selected action
+        action: int
+            Index in the action space of the greedy selected action
 
         qvalues : np.ndarray
             Q values associated to the actions space
         """
         if not side_only:
-            qvalues = self.model(
-                np.atleast_2d(states.astype("float32")), training=False
-            )
-            action = self.action_space.values[np.argmax(qvalues[0])]
+            qvalues = self.model.fast_call(states)
+            action = np.argmax(qvalues[0])
             return action, None
         else:
 
-            qvalues = self.model(
-                np.atleast_2d(states.astype("float32")), training=False
-            )
-            action = self.action_space.values[np.argmax(qvalues[0])]
+            qvalues = self.model.fast_call(states)
+            action = np.argmax(qvalues[0])
             return action, qvalues
 
     def add_experience(self, exp):
         """Parameters
         ----------
         exp: dict
-            Sequences of experience to store
+            Sequences of experience to store. The action is the index of the
+            action in the action space
 
         """
+        # action indices are stored as int16
+        exp = dict(exp, a=np.int16(exp["a"]))
         if self.use_PER:
             self.PERmemory.add(exp)
         else:
-            if len(self.experience["s"]) >= self.max_experiences:
-                for key in self.experience.keys():
-                    if self.experience[key]:  # check if the list is not empty
-                        self.experience[key].pop(0)
-            for key, value in exp.items():
-                self.experience[key].append(value)
+            self.memory.add(exp)
 
     def copy_weights(self):
         """Parameters
@@ -6,6 +6,7 @@ from torch.optim.lr_scheduler import StepLR, ExponentialLR
 from torch.distributions import Normal, Categorical
 from torch.utils.tensorboard import SummaryWriter
 import numpy as np
+from scipy.signal import lfilter
 from typing import Optional, Union
 import pdb
 import sys
@@ -211,6 +212,97 @@ class PPOActorCritic(nn.Module):
         #             nn.init.constant_(layer.bias, 0.01)
 
 
+################################ Rollout buffer ################################
+class RolloutBuffer:
+    """
+    Preallocated storage of the rollouts collected by PPO. Each experience field
+    is backed by a torch tensor on the training device, written in place at each
+    step, so that the minibatches of every epoch are obtained by indexing the
+    stored tensors without going through numpy.
+    ...
+
+    Attributes
+    ----------
+    max_steps: int
+        Number of steps preallocated for each field. The buffer doubles its
+        capacity if a longer rollout is collected
+
+    device: torch.device
+        Device where the tensors are allocated
+
+    n_steps: int
+        Number of steps stored in the current rollout
+
+    tensors: dict
+        Dictionary of field name -> tensor of shape (max_steps, ...). Rewards
+        are stored as float64 as they only enter the advantage estimation,
+        all the other fields as float32
+
+    Methods
+    -------
+    reset(max_steps: int = None)
+        Empty the buffer, keeping the allocated tensors when they are large enough
+
+    add(exp: dict)
+        Write the experience of one step (of one or more environments) in place
+
+    __getitem__(key: str) -> torch.Tensor
+        View of the stored steps of the field given by key
+
+    __setitem__(key: str, value: Union[np.ndarray or torch.Tensor])
+        Overwrite the stored steps of the field given by key (e.g. advantages)
+    """
+
+    def __init__(self, device: torch.device, max_steps: int = 1):
+        self.device = device
+        self.max_steps = max_steps
+        self.n_steps = 0
+        self.tensors = {}
+
+    def __len__(self) -> int:
+        return self.n_steps
+
+    def reset(self, max_steps: int = None):
+        if max_steps is not None and max_steps > self.max_steps:
+            self.max_steps = max_steps
+            self.tensors = {}
+        self.n_steps = 0
+
+    def add(self, exp: dict):
+        if self.n_steps >= self.max_steps:
+            self._grow(2 * self.max_steps)
+        for key, value in exp.items():
+            value = torch.as_tensor(value)
+            if key not in self.tensors:
+                self._allocate(key, value.shape)
+            self.tensors[key][self.n_steps] = value
+        self.n_steps += 1
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        return self.tensors[key][: self.n_steps]
+
+    def __setitem__(self, key: str, value: Union[np.ndarray or torch.Tensor]):
+        value = torch.as_tensor(value)
+        if key not in self.tensors:
+            self._allocate(key, value.shape[1:])
+        tensor = self.tensors[key]
+        tensor[: self.n_steps] = value.reshape((self.n_steps,) + tensor.shape[1:])
+
+    # PRIVATE METHODS
+    def _allocate(self, key: str, shape: tuple):
+        dtype = torch.float64 if key == "reward" else torch.float32
+        self.tensors[key] = torch.zeros(
+            (self.max_steps,) + tuple(shape), dtype=dtype, device=self.device
+        )
+
+    def _grow(self, max_steps: int):
+        for key, tensor in self.tensors.items():
+            new_tensor = tensor.new_zeros((max_steps,) + tensor.shape[1:])
+            new_tensor[: self.max_steps] = tensor
+            self.tensors[key] = new_tensor
+        self.max_steps = max_steps
+
+
 # ############################### DQN ALGORITHM ################################
 @gin.configurable()
 class PPO:
@@ -273,15 +365,7 @@ class PPO:
         self.batch_norm_input = batch_norm_input
         self.store_diagnostics = store_diagnostics
 
-        self.experience = {
-            "state": [],
-            "action": [],
-            "reward": [],
-            "log_prob": [],
-            "value": [],
-            "returns": [],
-            "advantage": [],
-        }
+        self.experience = RolloutBuffer(self.device)
 
         self.model = PPOActorCritic(
             seed,
@@ -428,81 +512,76 @@ class PPO:
     def act(self, states):
         # useful when the states are single dimensional
         self.model.eval()
-        # make 1D tensor to 2D
+        # make 1D tensor to 2D, while a batch of states is kept as it is
         with torch.no_grad():
-            states = torch.from_numpy(states).float().unsqueeze(0)
+            states = torch.from_numpy(np.atleast_2d(states)).float()
             states = states.to(self.device)
             return self.model(states)
 
     def compute_gae(self, next_value, recompute_value=False):
-
+        # rollouts are stacked along the time axis, with one column per rollout
+        # when a batch of them is collected from multiple environments
         if recompute_value:
+            states = self.experience["state"]
             self.model.eval()
             with torch.no_grad():
-                _, values = self.model(
-                    torch.Tensor(self.experience["state"]).to(self.device)
-                )
-            self.experience["value"] = [
-                np.array(v, dtype=float) for v in values.detach().cpu().tolist()
-            ]
+                _, values = self.model(states.reshape(-1, states.shape[-1]))
+            self.experience["value"] = values
             # for i in range(len(self.experience["value"])):
             #     _, value = self.act(self.experience["state"][i])
             #     self.experience["value"][i] = value.detach().cpu().numpy().ravel()
 
-        rewards = self.experience["reward"]
-        values = self.experience["value"]
+        values = self.experience["value"].cpu().numpy().astype(float)
+        values = values.reshape(len(values), -1)
+        rewards = self.experience["reward"].cpu().numpy().reshape(values.shape)
+        next_value = np.asarray(next_value, dtype=float).reshape(1, -1)
 
-        values = values + [next_value]
-        gae = 0
-        returns = []
-        for step in reversed(range(len(rewards))):
-            delta = rewards[step] + self.gamma * values[step + 1] - values[step]
-            gae = delta + self.gamma * self.tau * gae
-            returns.insert(0, gae + values[step])
+        deltas = (
+            rewards
+            + self.gamma * np.concatenate([values[1:], next_value], axis=0)
+            - values
+        )
+        # reverse discounted scan gae_t = delta_t + gamma * tau * gae_{t+1}
+        gae = lfilter([1], [1, -self.gamma * self.tau], deltas[::-1], axis=0)[::-1]
 
         # add estimated returns and advantages to the experience
+        returns = gae + values
         self.experience["returns"] = returns
-
-        advantage = [returns[i] - values[i] for i in range(len(returns))]
-        self.experience["advantage"] = advantage
+        self.experience["advantage"] = returns - values
 
     # add way to reset experience after one rollout
     def add_experience(self, exp):
-        for key, value in exp.items():
-            self.experience[key].append(value)
-
-    def reset_experience(self):
+        self.experience.add(exp)
 
-        self.experience = {
-            "state": [],
-            "action": [],
-            "reward": [],
-            "log_prob": [],
-            "value": [],
-            "returns": [],
-            "advantage": [],
-        }
+    def reset_experience(self, n_steps: int = None):
+        # the buffer is preallocated for the length of the rollout when known
+        self.experience.reset(n_steps)
 
     def ppo_iter(self):
         # pick a batch from the rollout
-        states = np.asarray(self.experience["state"])
-        actions = np.asarray(self.experience["action"])
-        log_probs = np.asarray(self.experience["log_prob"])
-        returns = np.asarray(self.experience["returns"])
-        advantage = np.asarray(self.experience["advantage"])
+        # rollouts collected from multiple environments are merged in one batch
+        states = self.experience["state"]
+        states = states.reshape(-1, states.shape[-1])
+        actions = self.experience["action"]
+        actions = actions.reshape(-1, actions.shape[-1])
+        log_probs = self.experience["log_prob"]
+        log_probs = log_probs.reshape(-1, log_probs.shape[-1])
+        returns = self.experience["returns"].reshape(-1, 1)
+        advantage = self.experience["advantage"].reshape(-1, 1)
 
         len_rollout = states.shape[0]
         ids = self.rng.permutation(len_rollout)
         ids = np.array_split(ids, len_rollout // self.batch_size)
         self.n_batches = len(ids)
         for i in range(len(ids)):
+            batch_ids = torch.from_numpy(ids[i]).to(self.device)
 
             yield (
-                torch.from_numpy(states[ids[i], :]).float().to(self.device),
-                torch.from_numpy(actions[ids[i], :]).float().to(self.device),
-                torch.from_numpy(log_probs[ids[i], :]).float().to(self.device),
-                torch.from_numpy(returns[ids[i], :]).float().to(self.device),
-                torch.from_numpy(advantage[ids[i], :]).float().to(self.device),
+                states[batch_ids],
+                actions[batch_ids],
+                log_probs[batch_ids],
+                returns[batch_ids],
+                advantage[batch_ids],
             )
 
     def add_tb_diagnostics(self,path,n_epochs):
@@ -43,6 +43,8 @@ from utils.plot import (
     plot_2asset_holding
 )
 from utils.test import Out_sample_vs_gp
+from utils.results import read_oos_metrics, pivot_oos_metric, parse_oos_filename
+from utils.catalog import find_runs
 from utils.env import MarketEnv, CashMarketEnv, ShortCashMarketEnv, MultiAssetCashMarketEnv, ShortMultiAssetCashMarketEnv
 from agents.DQN import DQN
 from agents.PPO import PPO
@@ -82,6 +84,7 @@ def runplot_metrics(p):
         color = (r, g, b)
         colors.append(color)
 
+    tables = {}
     for t in tag:
 
         
@@ -100,43 +103,21 @@ def runplot_metrics(p):
                     fig = plt.figure(figsize=set_size(width=1000)) #600
                     # fig.subplots_adjust(wspace=0.2, hspace=0.6)
                     ax = fig.add_subplot()
-                modelpath = "outputs/{}/{}".format(outputClass, out_mode)
-
-                # get the latest created folder "length"
-                all_subdirs = [
-                    os.path.join(modelpath, d)
-                    for d in os.listdir(modelpath)
-                    if os.path.isdir(os.path.join(modelpath, d))
-                ]
-                latest_subdir = max(all_subdirs, key=os.path.getmtime)
-                length = os.path.split(latest_subdir)[-1]
-
-                data_dir = "outputs/{}/{}/{}".format(outputClass, out_mode, length)
+                # get the latest length of the experiment and its runs
+                data_dir, run_dirs = find_runs(outputClass, out_mode)
 
                 # Recover and plot generated multi test OOS ----------------------------------------------------------------
-                filtered_dir = [
-                    dirname
-                    for dirname in os.listdir(data_dir)
-                    if os.path.isdir(os.path.join(os.getcwd(), data_dir, dirname))
-                ]
                 logging.info(
                     "Plotting experiment {} for variable {}...".format(out_mode, v)
                 )
-                dfs = []
-                for exp in filtered_dir:
-                    exp_path = os.path.join(data_dir, exp)
-                    df = pd.read_parquet(os.path.join(exp_path, v))
-
-                    # filenamep = os.path.join(
-                    #     data_dir, exp, "config.yaml".format(length)
-                    # )
-                    # p_mod = readConfigYaml(filenamep)
-                    filenamep = os.path.join(data_dir, exp, "config.gin")
-
-                    dfs.append(df)
-
-                dataframe = pd.concat(dfs)
-                dataframe.index = range(len(dfs))
+                # the metrics of all the runs are read once per folder
+                if data_dir not in tables:
+                    tables[data_dir] = read_oos_metrics(
+                        run_dirs, format_tousands(N_test)
+                    )
+                metric, _, agent = parse_oos_filename(v)
+                dataframe = pivot_oos_metric(tables[data_dir], metric, agent)
+                filenamep = os.path.join(run_dirs[-1], "config.gin")
 
                 # pdb.set_trace()
                 if 'PPO' in tag and p['ep_ppo']:
@@ -144,15 +125,7 @@ def runplot_metrics(p):
 
                 if "Abs" in v or 'Pdist' in v:
 
-                    dfs_opt = []
-                    for exp in filtered_dir:
-                        exp_path = os.path.join(data_dir, exp)
-                        df_opt = pd.read_parquet(
-                            os.path.join(exp_path, v.replace(t, "GP"))
-                        )
-                        dfs_opt.append(df_opt)
-                    dataframe_opt = pd.concat(dfs_opt)
-                    dataframe_opt.index = range(len(dfs_opt))
+                    dataframe_opt = pivot_oos_metric(tables[data_dir], metric, "GP")
                     if 'PPO' in tag and p['ep_ppo']:
                         dataframe_opt = dataframe_opt.iloc[:,:dataframe_opt.columns.get_loc(p['ep_ppo'])]
                     # pdb.set_trace()
@@ -211,18 +184,9 @@ def runplot_value(p):
         outputModel = outputModel.format(*hp_exp)
         experiment = experiment.format(*hp_exp, seed)
 
-    modelpath = "outputs/{}/{}".format(outputClass, outputModel)
     # get the latest created folder "length"
-    all_subdirs = [
-        os.path.join(modelpath, d)
-        for d in os.listdir(modelpath)
-        if os.path.isdir(os.path.join(modelpath, d))
-    ]
-    latest_subdir = max(all_subdirs, key=os.path.getmtime)
-    length = os.path.split(latest_subdir)[-1]
-    data_dir = "outputs/{}/{}/{}/{}".format(
-        outputClass, outputModel, length, experiment
-    )
+    data_dir, _ = find_runs(outputClass, outputModel)
+    data_dir = os.path.join(data_dir, experiment)
 
     gin.parse_config_file(os.path.join(data_dir, "config.gin"), skip_unknown=True)
 
@@ -285,18 +249,9 @@ def runplot_policy(p):
         outputModel = outputModel.format(*hp_exp)
         experiment = experiment.format(*hp_exp, seed)
 
-    modelpath = "outputs/{}/{}".format(outputClass, outputModel)
     # get the latest created folder "length"
-    all_subdirs = [
-        os.path.join(modelpath, d)
-        for d in os.listdir(modelpath)
-        if os.path.isdir(os.path.join(modelpath, d))
-    ]
-    latest_subdir = max(all_subdirs, key=os.path.getmtime)
-    length = os.path.split(latest_subdir)[-1]
-    data_dir = "outputs/{}/{}/{}/{}".format(
-        outputClass, outputModel, length, experiment
-    )
+    data_dir, _ = find_runs(outputClass, outputModel)
+    data_dir = os.path.join(data_dir, experiment)
 
     fig = plt.figure(figsize=set_size(width=1000.0))
     ax = fig.add_subplot()
@@ -388,18 +343,9 @@ def runplot_distribution(p):
         experiment = experiment.format(*hp_exp, seed)
 
 
-    modelpath = "outputs/{}/{}".format(outputClass, outputModel)
     # get the latest created folder "length"
-    all_subdirs = [
-        os.path.join(modelpath, d)
-        for d in os.listdir(modelpath)
-        if os.path.isdir(os.path.join(modelpath, d))
-    ]
-    latest_subdir = max(all_subdirs, key=os.path.getmtime)
-    length = os.path.split(latest_subdir)[-1]
-    data_dir = "outputs/{}/{}/{}/{}".format(
-        outputClass, outputModel, length, experiment
-    )
+    data_dir, _ = find_runs(outputClass, outputModel)
+    data_dir = os.path.join(data_dir, experiment)
 
 
     gin.parse_config_file(os.path.join(data_dir, "config.gin"), skip_unknown=True)
@@ -747,21 +693,11 @@ def runplot_holding(p):
     axes4 = [ax14, ax24, ax34, ax44]
 
     for i, model in enumerate(outputModel):
-        modelpath = "outputs/{}/{}".format(outputClass, model)
-        # get the latest created folder "length"
-        all_subdirs = [
-            os.path.join(modelpath, d)
-            for d in os.listdir(modelpath)
-            if os.path.isdir(os.path.join(modelpath, d))
-        ]
-        latest_subdir = max(all_subdirs, key=os.path.getmtime)
-        length = os.path.split(latest_subdir)[-1]
-        experiment = [
-            exp
-            for exp in os.listdir("outputs/{}/{}/{}".format(outputClass, model, length))
-            if seed in exp
+        # get the run of the given seed in the latest created folder "length"
+        _, run_dirs = find_runs(outputClass, model)
+        data_dir = [
+            run_dir for run_dir in run_dirs if seed in os.path.basename(run_dir)
         ][0]
-        data_dir = "outputs/{}/{}/{}/{}".format(outputClass, model, length, experiment)
 
         gin.parse_config_file(os.path.join(data_dir, "config.gin"), skip_unknown=True)
         gin.bind_parameter('alpha_term_structure_sampler.generate_plot', p['generate_plot'])
@@ -937,33 +873,17 @@ def runplot_diagnostics(p):
                 # fig.subplots_adjust(wspace=0.2, hspace=0.6)
                 ax = fig.add_subplot()
 
-                modelpath = "outputs/{}/{}".format(outputClass, out_mode)
-
-                # get the latest created folder "length"
-                all_subdirs = [
-                    os.path.join(modelpath, d)
-                    for d in os.listdir(modelpath)
-                    if os.path.isdir(os.path.join(modelpath, d))
-                ]
-                latest_subdir = max(all_subdirs, key=os.path.getmtime)
-                length = os.path.split(latest_subdir)[-1]
-
-                data_dir = "outputs/{}/{}/{}".format(outputClass, out_mode, length)
+                # get the latest length of the experiment and its runs
+                _, run_dirs = find_runs(outputClass, out_mode)
 
                 # Recover and plot generated multi test OOS ----------------------------------------------------------------
-                filtered_dir = [
-                    dirname
-                    for dirname in os.listdir(data_dir)
-                    if os.path.isdir(os.path.join(os.getcwd(), data_dir, dirname))
-                ]
                 logging.info(
                     "Plotting experiment {} for variable {}...".format(out_mode, v)
                 )
                 dfs = []
-                for exp in filtered_dir:
-                    exp_path = os.path.join(data_dir, exp)
+                for exp_path in run_dirs:
                     array = np.load(os.path.join(exp_path, v))
-                    df = pd.DataFrame(array, columns=[exp])
+                    df = pd.DataFrame(array, columns=[os.path.basename(exp_path)])
 
                     dfs.append(df)
 
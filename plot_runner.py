@@ -19,6 +19,8 @@ from utils.env import (
 )
 from utils.tools import CalculateLaggedSharpeRatio, RunModels
 from utils.test import Out_sample_test, Out_sample_Misspec_test
+from utils.results import read_oos_metric
+from utils.catalog import find_runs
 from tqdm import tqdm
 import seaborn as sns
 import matplotlib
@@ -65,29 +67,15 @@ def runPnlSRPlots(p: dict, pair: list, outputModel: str):
 
         for ax, v in zip(pair, var_plot):
             for j, out_mode in enumerate(outputModel):
-                data_dir = "outputs/{}/{}/{}".format(outputClass, out_mode, length)
+                data_dir, run_dirs = find_runs(outputClass, out_mode, length=length)
 
                 # Recover and plot generated multi test OOS ----------------------------------------------------------------
-                filtered_dir = [
-                    dirname
-                    for dirname in os.listdir(data_dir)
-                    if os.path.isdir(os.path.join(os.getcwd(), data_dir, dirname))
-                ]
                 logging.info(
                     "Plotting experiment {} for variable {}...".format(out_mode, v)
                 )
-                dfs = []
-                for exp in filtered_dir:
-                    exp_path = os.path.join(data_dir, exp)
-                    df = pd.read_parquet(os.path.join(exp_path, v))
-                    filenamep = os.path.join(
-                        data_dir, exp, "config_{}.yaml".format(length)
-                    )
-                    p_mod = readConfigYaml(filenamep)
-                    dfs.append(df)
-
-                dataframe = pd.concat(dfs)
-                dataframe.index = range(len(dfs))
+                filenamep = os.path.join(run_dirs[-1], "config_{}.yaml".format(length))
+                p_mod = readConfigYaml(filenamep)
+                dataframe = read_oos_metric(run_dirs, v)
 
                 if "NetPnl_OOS" in v and "DQN" in v and "GARCH" not in out_mode:
                     for i in dataframe.index:
@@ -158,29 +146,15 @@ def runRewplots(p, pair, outputModel):
 
         for ax, v in zip(pair, var_plot):
             for j, out_mode in enumerate(outputModel):
-                data_dir = "outputs/{}/{}/{}".format(outputClass, out_mode, length)
+                data_dir, run_dirs = find_runs(outputClass, out_mode, length=length)
 
                 # Recover and plot generated multi test OOS ----------------------------------------------------------------
-                filtered_dir = [
-                    dirname
-                    for dirname in os.listdir(data_dir)
-                    if os.path.isdir(os.path.join(os.getcwd(), data_dir, dirname))
-                ]
                 logging.info(
                     "Plotting experiment {} for variable {}...".format(out_mode, v)
                 )
-                dfs = []
-                for exp in filtered_dir:
-                    exp_path = os.path.join(data_dir, exp)
-                    df = pd.read_parquet(os.path.join(exp_path, v))
-                    filenamep = os.path.join(
-                        data_dir, exp, "config_{}.yaml".format(length)
-                    )
-                    p_mod = readConfigYaml(filenamep)
-                    dfs.append(df)
-
-                dataframe = pd.concat(dfs)
-                dataframe.index = range(len(dfs))
+                filenamep = os.path.join(run_dirs[-1], "config_{}.yaml".format(length))
+                p_mod = readConfigYaml(filenamep)
+                dataframe = read_oos_metric(run_dirs, v)
 
                 if len(outputModel) > 1:
                     coloridx = j
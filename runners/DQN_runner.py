@@ -146,12 +146,13 @@ class DQN_runner(MixinCore):
         self.logging.debug("Instantiating DQN model")
         input_shape = self.env.get_state_dim()
 
-        self.train_agent = DQN(
-            input_shape=input_shape,
-            action_space=self.action_space,
-            rng=self.rng,
-            N_train=self.N_train,
-        )
+        self.agent_kwargs = {
+            "input_shape": input_shape,
+            "action_space": self.action_space,
+            "rng": self.rng,
+            "N_train": self.N_train,
+        }
+        self.train_agent = DQN(**self.agent_kwargs)
 
         self.logging.debug("Set up length of training and instantiate test env")
         self.train_agent._get_exploration_length(self.N_train)
@@ -198,15 +199,16 @@ class DQN_runner(MixinCore):
             side_only = self.action_space.side_only
             copy_step = self.train_agent.copy_step
 
+            # the agent works with action indices, mapped to values for the env only
             action, qvalues = self.train_agent.eps_greedy_action(
                 CurrState, epsilon, side_only=side_only
             )
             if not side_only:
-                unscaled_action = action
+                unscaled_action = self.action_space.get_value(action)
             else:
                 unscaled_action = get_bet_size(
                     qvalues,
-                    action,
+                    self.action_space.get_value(action),
                     action_limit=self.action_space.action_range[0],
                     zero_action=self.action_space.zero_action,
                     rng=self.rng,
@@ -244,7 +246,9 @@ class DQN_runner(MixinCore):
                 )
 
                 self.logging.debug("Testing...")
-                self.oos_test.run_test(it=i, test_agent=self.train_agent)
+                self.oos_test.submit_test(
+                    self.train_agent, it=i, agent_kwargs=self.agent_kwargs
+                )
 
             # if executeGP:
             #     NextOptState, OptResult = env.opt_step(
@@ -255,7 +259,11 @@ class DQN_runner(MixinCore):
 
         self.oos_test.save_series()
 
-        save_gin(os.path.join(self.savedpath, "config.gin"))
+        save_gin(
+            os.path.join(self.savedpath, "config.gin"),
+            seed=self.seed,
+            checkpoints=self.col_names_oos,
+        )
         logging.info("Config file saved")
 
     # def training_episodic_agent(self):
@@ -24,6 +24,7 @@ from utils.spaces import (
     ResActionSpace,
 )
 from utils.simulation import DataHandler
+from utils.env import VecMarketEnv
 from agents.PPO import PPO
 from utils.tools import get_action_boundaries, get_bet_size, CalculateLaggedSharpeRatio
 from utils.test import Out_sample_vs_gp
@@ -53,6 +54,10 @@ class PPO_runner(MixinCore):
         varying_type: str = "chunk",
         num_cores: int = None,
         universal_train: bool = False,
+        per_step_gae: bool = False,
+        n_rollout_envs: int = 1,
+        corr_type: str = "pairwise",
+        corr_factors: int = 1,
     ):
 
         self.logging.info("Starting model setup")
@@ -131,17 +136,41 @@ class PPO_runner(MixinCore):
             factors=self.data_handler.factors,
         )
 
+        # additional copies of the environment on independently simulated series,
+        # whose rollouts are collected together with a batched forward pass
+        self.data_handlers = [self.data_handler]
+        envs = [self.env]
+        for _ in range(self.n_rollout_envs - 1):
+            data_handler = DataHandler(N_train=self.len_series, rng=self.rng)
+            data_handler.generate_returns(disable_tqdm=True)
+            if self.experiment_type != "GP":
+                data_handler.estimate_parameters()
+            self.data_handlers.append(data_handler)
+            envs.append(
+                self.env_cls(
+                    N_train=self.N_train,
+                    f_speed=data_handler.f_speed,
+                    returns=data_handler.returns,
+                    factors=data_handler.factors,
+                )
+            )
+        self.rollout_env = VecMarketEnv(envs)
+
         self.logging.debug("Instantiating DQN model")
         input_shape = self.env.get_state_dim()
 
+        # the rollouts of all the environment copies are merged in one batch
         step_size = (
-            self.len_series / gin.query_parameter("PPO.batch_size")
+            self.len_series * self.n_rollout_envs / gin.query_parameter("PPO.batch_size")
         ) * gin.query_parameter("%EPOCHS")
         gin.bind_parameter("PPO.step_size", step_size)
 
-        self.train_agent = PPO(
-            input_shape=input_shape, action_space=self.action_space, rng=self.rng
-        )
+        self.agent_kwargs = {
+            "input_shape": input_shape,
+            "action_space": self.action_space,
+            "rng": self.rng,
+        }
+        self.train_agent = PPO(**self.agent_kwargs)
 
         self.train_agent.add_tb_diagnostics(self.savedpath,self.epochs)
 
@@ -178,16 +207,17 @@ class PPO_runner(MixinCore):
         for e in tqdm(iterable=range(self.episodes), desc="Running episodes..."):
 
             if e > 0 and self.universal_train:
-                if self.experiment_type == "GP":
-                    self.data_handler.generate_returns(disable_tqdm=True)
-                else:
-                    self.data_handler.generate_returns(disable_tqdm=True)
-                    # TODO check if these method really fit and change the parameters in the gin file
-                    self.data_handler.estimate_parameters()
-
-                self.env.returns = self.data_handler.returns
-                if self.data_handler.datatype != "alpha_term_structure":
-                    self.env.factors = self.data_handler.factors
+                for data_handler, env in zip(self.data_handlers, self.rollout_env.envs):
+                    if self.experiment_type == "GP":
+                        data_handler.generate_returns(disable_tqdm=True)
+                    else:
+                        data_handler.generate_returns(disable_tqdm=True)
+                        # TODO check if these method really fit and change the parameters in the gin file
+                        data_handler.estimate_parameters()
+
+                    env.returns = data_handler.returns
+                    if data_handler.datatype != "alpha_term_structure":
+                        env.factors = data_handler.factors
             
             self.logging.debug("Training...")
 
@@ -207,13 +237,19 @@ class PPO_runner(MixinCore):
                 self.logging.debug("Testing...")
                 n_assets = gin.query_parameter('%N_ASSETS')
                 if n_assets<3 or n_assets == None:
-                    self.oos_test.run_test(it=e + 1, test_agent=self.train_agent)
+                    self.oos_test.submit_test(
+                        self.train_agent, it=e + 1, agent_kwargs=self.agent_kwargs
+                    )
         if n_assets<3 or n_assets == None:
             self.oos_test.save_series()
             # self.train_agent.save_diagnostics(path=self.savedpath)
 
 
-        save_gin(os.path.join(self.savedpath, "config.gin"))
+        save_gin(
+            os.path.join(self.savedpath, "config.gin"),
+            seed=self.seed,
+            checkpoints=self.col_names_oos,
+        )
         logging.info("Config file saved")
 
     # def testing_agent(self):
@@ -270,11 +306,18 @@ class PPO_runner(MixinCore):
 
     def collect_rollouts(self):
 
+        if self.n_rollout_envs > 1:
+            self.collect_vec_rollouts()
+            return
+
         state = self.env.reset()
 
-        self.train_agent.reset_experience()
+        self.train_agent.reset_experience(n_steps=len(self.env.returns) - 2)
+        # wall-clock time spent in each phase of the rollout collection
+        self.timings = {"act": 0.0, "env": 0.0, "gae": 0.0}
 
         for i in range(len(self.env.returns) - 2):
+            start = time.perf_counter()
             dist, value = self.train_agent.act(state)
 
             if self.train_agent.policy_type == "continuous":
@@ -305,7 +348,9 @@ class PPO_runner(MixinCore):
             else:
                 print("Select a policy as continuous or discrete")
                 sys.exit()
+            self.timings["act"] += time.perf_counter() - start
 
+            start = time.perf_counter()
             if self.MV_res:
                 if len(unscaled_action)>1:
                     next_state, Result = self.env.MV_res_step(
@@ -319,6 +364,7 @@ class PPO_runner(MixinCore):
                 next_state, Result, _ = self.env.step(
                     state, unscaled_action[0], i, tag="PPO"
                 )
+            self.timings["env"] += time.perf_counter() - start
 
             exp = {
                 "state": state,
@@ -335,9 +381,100 @@ class PPO_runner(MixinCore):
 
             state = next_state
 
-            _, self.next_value = self.train_agent.act(next_state)
-            # compute the advantage estimate from the given rollout
-            self.train_agent.compute_gae(self.next_value.detach().cpu().numpy().ravel())
+            if self.per_step_gae:
+                # legacy mode: the advantages of the partial rollout are
+                # recomputed at every step, which is quadratic in len_series
+                self._bootstrap_gae(state)
+
+        if not self.per_step_gae:
+            # bootstrap once from the state where the rollout is truncated
+            self._bootstrap_gae(state)
+
+        self.logging.debug(
+            "Rollout timings: "
+            + ", ".join("{} {:.3f}s".format(k, v) for k, v in self.timings.items())
+        )
+
+    def collect_vec_rollouts(self):
+
+        states = self.rollout_env.reset()
+
+        self.train_agent.reset_experience(n_steps=len(self.env.returns) - 2)
+        # wall-clock time spent in each phase of the rollout collection
+        self.timings = {"act": 0.0, "env": 0.0, "gae": 0.0}
+
+        for i in range(len(self.env.returns) - 2):
+            start = time.perf_counter()
+            # one forward pass for the states of all the environments
+            dist, values = self.train_agent.act(states)
+
+            if self.train_agent.policy_type == "continuous":
+                actions = dist.sample()
+
+                log_probs = dist.log_prob(actions)
+                clipped_actions = nn.Tanh()(actions).cpu().numpy()
+                actions = actions.cpu().numpy()
+                if self.MV_res:
+                    unscaled_actions = unscale_asymmetric_action(
+                        self.action_space.action_range[0],self.action_space.action_range[1], clipped_actions
+                    )
+                else:
+                    unscaled_actions = unscale_action(
+                        self.action_space.action_range[0], clipped_actions
+                    )
+
+            elif self.train_agent.policy_type == "discrete":
+                actions = dist.sample()
+                log_probs = dist.log_prob(actions)
+
+                unscaled_actions = self.action_space.values[
+                    actions.cpu().numpy()
+                ].reshape(-1, 1).astype("float32")
+                actions = actions.cpu().numpy().reshape(-1, 1).astype("float32")
+
+            else:
+                print("Select a policy as continuous or discrete")
+                sys.exit()
+            self.timings["act"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            # single asset environments take the scalar action
+            if unscaled_actions.shape[1] == 1:
+                unscaled_actions = unscaled_actions[:, 0]
+            next_states, Results = self.rollout_env.step(
+                states, unscaled_actions, i, tag="PPO", MV_res=self.MV_res
+            )
+            self.timings["env"] += time.perf_counter() - start
+
+            exp = {
+                "state": states,
+                "action": actions,
+                "reward": Results["Reward_PPO"],
+                "log_prob": log_probs.detach()
+                .cpu()
+                .numpy()
+                .reshape(len(states), -1),  # avoid require_grad and go back to numpy array
+                "value": values.detach().cpu().numpy().ravel(),
+            }
+
+            self.train_agent.add_experience(exp)
+
+            states = next_states
+
+        # bootstrap once from the states where the rollouts are truncated
+        self._bootstrap_gae(states)
+
+        self.logging.debug(
+            "Rollout timings: "
+            + ", ".join("{} {:.3f}s".format(k, v) for k, v in self.timings.items())
+        )
+
+    def _bootstrap_gae(self, last_state: np.ndarray):
+        start = time.perf_counter()
+        _, self.next_value = self.train_agent.act(last_state)
+        # compute the advantage estimate from the given rollout
+        self.train_agent.compute_gae(self.next_value.detach().cpu().numpy().ravel())
+        self.timings["gae"] += time.perf_counter() - start
 
     def update(self,episode):
         for i in range(self.epochs):  # run for more than one epochs
@@ -363,4 +500,13 @@ class PPO_runner(MixinCore):
         gin.bind_parameter('%HALFLIFE',[[rng.randint(low=5,high=150)] for _ in range(n_assets)])
         gin.bind_parameter('%INITIAL_ALPHA',[[np.round(rng.uniform(low=0.0,high=0.004),5)] for _ in range(n_assets)])
         gin.bind_parameter('%F_PARAM',[[1.0] for _ in range(n_assets)])
-        gin.bind_parameter('%CORRELATION',list(np.round(rng.uniform(size=(int((n_assets**2 - n_assets)/2))),5)))
\ No newline at end of file
+        if self.corr_type == "pairwise":
+            gin.bind_parameter('%CORRELATION',list(np.round(rng.uniform(size=(int((n_assets**2 - n_assets)/2))),5)))
+        elif self.corr_type == "factor":
+            # squared row sums of the loadings stay below 1 as required by CorrelationSpec
+            loadings = rng.uniform(low=-1.0, high=1.0, size=(n_assets, self.corr_factors))
+            loadings = np.round(0.95 * loadings / np.sqrt(self.corr_factors), 5)
+            gin.bind_parameter('%CORRELATION', {"type": "factor", "loadings": loadings.tolist()})
+        else:
+            print("Choose corr_type as pairwise or factor")
+            sys.exit()
\ No newline at end of file
@@ -0,0 +1,82 @@
+import os
+import gin
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from runners.PPO_runner import PPO_runner
+
+CONFIG = os.path.join(os.path.dirname(__file__), os.pardir, "config", "main_config.gin")
+
+
+def collect_rollout(per_step_gae: bool, n_rollout_envs: int) -> PPO_runner:
+    """Collect one seeded rollout and return the runner holding its experience"""
+    gin.clear_config()
+    gin.parse_config_file(CONFIG, skip_unknown=True)
+    for k, v in [
+        ("%EPISODES", 1),
+        ("%LEN_SERIES", 60),
+        ("%SAVE_FREQ", 1),
+        ("%VARYING_PARS", None),
+        ("%SEED", 7),
+        ("%N_ASSETS", 2),
+        ("%OUTPUTMODEL", "gae_{}_{}".format(per_step_gae, n_rollout_envs)),
+    ]:
+        gin.bind_parameter(k, v)
+    gin.bind_parameter("MarketEnv.inputs", ["sigma", "corr", "holding", "cash"])
+    gin.bind_parameter("PPO_runner.per_step_gae", per_step_gae)
+    gin.bind_parameter("PPO_runner.n_rollout_envs", n_rollout_envs)
+
+    runner = PPO_runner()
+    runner.set_up_training()
+    runner.collect_rollouts()
+    return runner
+
+
+def loop_gae(rewards, values, next_value, gamma, tau) -> tuple:
+    """Reference copy of the step by step GAE of PPO.compute_gae before it was
+    vectorized, applied to rows of shape (n_rollout_envs,)"""
+    values = values + [next_value]
+    gae = 0
+    returns = []
+    for step in reversed(range(len(rewards))):
+        delta = rewards[step] + gamma * values[step + 1] - values[step]
+        gae = delta + gamma * tau * gae
+        returns.insert(0, gae + values[step])
+
+    advantage = [returns[i] - values[i] for i in range(len(returns))]
+    return np.array(advantage), np.array(returns)
+
+
+@pytest.mark.parametrize(
+    "per_step_gae, n_rollout_envs", [(True, 1), (False, 1), (False, 3)]
+)
+def test_gae_matches_loop_reference(tmp_path, monkeypatch, per_step_gae, n_rollout_envs):
+    monkeypatch.chdir(tmp_path)
+    runner = collect_rollout(per_step_gae, n_rollout_envs)
+    agent, experience = runner.train_agent, runner.train_agent.experience
+
+    rewards = experience["reward"].cpu().numpy().reshape(len(experience), -1)
+    values = experience["value"].cpu().numpy().astype(float)
+    values = values.reshape(len(experience), -1)
+    next_value = runner.next_value.detach().cpu().numpy().ravel().astype(float)
+
+    advantage, returns = loop_gae(
+        list(rewards), list(values), next_value, agent.gamma, agent.tau
+    )
+
+    assert advantage.shape == (60, n_rollout_envs)
+    np.testing.assert_allclose(
+        experience["advantage"].cpu().numpy().reshape(advantage.shape),
+        advantage,
+        rtol=1e-5,
+        atol=1e-6,
+    )
+    np.testing.assert_allclose(
+        experience["returns"].cpu().numpy().reshape(returns.shape),
+        returns,
+        rtol=1e-5,
+        atol=1e-6,
+    )
+    assert set(runner.timings) == {"act", "env", "gae"}
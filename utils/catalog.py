@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import sqlite3
+from typing import Union, Optional
+import pandas as pd
+
+# the catalog lives in the main output directory of the experiments
+CATALOG_FILE = "catalog.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY,
+    output_class TEXT,
+    output_model TEXT,
+    length TEXT,
+    experiment TEXT,
+    hyperparams TEXT,
+    seed INTEGER,
+    checkpoints TEXT,
+    files TEXT,
+    config TEXT,
+    created REAL,
+    updated REAL
+)
+"""
+
+
+def register_run(
+    savedpath: str,
+    outputDir: str,
+    outputClass: str,
+    outputModel: str,
+    length: str,
+    hyperparams: Optional[dict] = None,
+):
+    """
+    Add a run to the catalog of its output directory, or reset its entry when
+    the run is launched again in the same folder.
+
+    Parameters
+    ----------
+    savedpath: str
+        Folder of the run
+
+    outputDir: str
+        Main directory for output results, which contains the catalog
+
+    outputClass: str
+        Subdirectory usually indicating the family of algorithms e.g. "DQN"
+
+    outputModel: str
+        Subdirectory indicating the name of the experiments
+
+    length: str
+        Subdirectory indicating the length of the training
+
+    hyperparams: Optional[dict]
+        Values of the varying hyperparameters of the run, if any
+    """
+    catalog = os.path.join(outputDir, CATALOG_FILE)
+    experiment = "" if not hyperparams else os.path.basename(savedpath)
+    now = time.time()
+    with _connect(catalog) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO runs "
+            "(path, output_class, output_model, length, experiment, hyperparams, "
+            "created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                _relpath(savedpath, catalog),
+                outputClass,
+                outputModel,
+                length,
+                experiment,
+                json.dumps(hyperparams or {}, default=repr),
+                now,
+                now,
+            ),
+        )
+
+
+def update_run(
+    savedpath: str,
+    config: str,
+    seed: Optional[int] = None,
+    checkpoints: Optional[list] = None,
+):
+    """
+    Record the outputs of a run in the catalog found in one of the parent folders
+    of the run. Runs outside of a cataloged output directory are ignored.
+
+    Parameters
+    ----------
+    savedpath: str
+        Folder of the run
+
+    config: str
+        Operative gin config of the run
+
+    seed: Optional[int]
+        Seed of the run
+
+    checkpoints: Optional[list]
+        Checkpoints at which the agent has been saved and tested
+    """
+    catalog = _find_catalog(savedpath)
+    if catalog is None:
+        return
+
+    files = sorted(
+        os.path.relpath(os.path.join(root, name), savedpath)
+        for root, _, names in os.walk(savedpath)
+        for name in names
+    )
+    with _connect(catalog) as conn:
+        conn.execute(
+            "UPDATE runs SET seed = ?, checkpoints = ?, files = ?, config = ?, "
+            "updated = ? WHERE path = ?",
+            (
+                seed,
+                json.dumps([str(c) for c in checkpoints or []]),
+                json.dumps(files),
+                config,
+                time.time(),
+                _relpath(savedpath, catalog),
+            ),
+        )
+
+
+def query_runs(
+    outputClass: str,
+    outputModel: Optional[str] = None,
+    length: Optional[str] = None,
+    outputDir: str = "outputs",
+    completed: bool = True,
+) -> Union[pd.DataFrame or None]:
+    """
+    Select runs from the catalog of an output directory
+
+    Parameters
+    ----------
+    outputClass: str
+        Subdirectory usually indicating the family of algorithms e.g. "DQN"
+
+    outputModel: Optional[str]
+        Name of the experiments. All the experiments of the class when None
+
+    length: Optional[str]
+        Length of the training. For each experiment only the latest created
+        length is selected when None
+
+    outputDir: str
+        Main directory for output results, which contains the catalog
+
+    completed: bool
+        Select only the runs whose config has been saved by save_gin, skipping
+        runs still in progress or crashed before writing their outputs
+
+    Returns
+    -------
+    runs: Union[pd.DataFrame or None]
+        One row per run, with the path of the run relative to the working
+        directory and json columns decoded. None if there is no catalog
+    """
+    catalog = os.path.join(outputDir, CATALOG_FILE)
+    if not os.path.exists(catalog):
+        return None
+
+    query, params = "SELECT * FROM runs WHERE output_class = ?", [outputClass]
+    if outputModel is not None:
+        query += " AND output_model = ?"
+        params.append(outputModel)
+    if length is not None:
+        query += " AND length = ?"
+        params.append(str(length))
+    if completed:
+        query += " AND config IS NOT NULL"
+    with _connect(catalog) as conn:
+        runs = pd.read_sql_query(query + " ORDER BY path", conn, params=params)
+
+    if length is None and len(runs):
+        created = runs.groupby(["output_model", "length"])["created"].transform("max")
+        latest = created.groupby(runs["output_model"]).transform("max")
+        runs = runs[created == latest]
+
+    runs["path"] = [
+        os.path.join(os.path.dirname(outputDir), path) for path in runs["path"]
+    ]
+    for col in ["hyperparams", "checkpoints", "files"]:
+        runs[col] = [json.loads(v) if v else None for v in runs[col]]
+    return runs.reset_index(drop=True)
+
+
+def find_runs(
+    outputClass: str,
+    outputModel: str,
+    length: Optional[str] = None,
+    outputDir: str = "outputs",
+) -> tuple:
+    """
+    Folder of the given (or latest) length of an experiment and folders of
+    its completed runs. The catalog is used when it has completed runs of the
+    experiment, otherwise the directory tree is scanned as for the outputs
+    produced before the catalog was introduced. Runs of the same experiment
+    that are not in the catalog are not merged with the cataloged ones.
+
+    Returns
+    -------
+    data_dir: str
+        Folder of the length of the experiment
+
+    run_dirs: list
+        Folders of the runs, data_dir itself when there are no varying parameters
+    """
+    runs = query_runs(outputClass, outputModel, length, outputDir=outputDir)
+    if runs is not None and len(runs):
+        length = runs["length"].iloc[0]
+        data_dir = os.path.join(outputDir, outputClass, outputModel, length)
+        return data_dir, list(runs["path"])
+
+    modelpath = os.path.join(outputDir, outputClass, outputModel)
+    if length is None:
+        # get the latest created folder "length"
+        all_subdirs = [
+            os.path.join(modelpath, d)
+            for d in os.listdir(modelpath)
+            if os.path.isdir(os.path.join(modelpath, d))
+        ]
+        length = os.path.split(max(all_subdirs, key=os.path.getmtime))[-1]
+    data_dir = os.path.join(modelpath, length)
+    # runs with varying parameters are subfolders with their own config
+    run_dirs = [
+        os.path.join(data_dir, d)
+        for d in sorted(os.listdir(data_dir))
+        if os.path.isdir(os.path.join(data_dir, d))
+        and any(f.startswith("config") for f in os.listdir(os.path.join(data_dir, d)))
+    ]
+    return data_dir, run_dirs or [data_dir]
+
+
+# PRIVATE FUNCTIONS
+def _connect(catalog: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(catalog)), exist_ok=True)
+    # parallel experiments write to the same catalog
+    conn = sqlite3.connect(catalog, timeout=60.0)
+    conn.execute(_SCHEMA)
+    return conn
+
+
+def _relpath(savedpath: str, catalog: str) -> str:
+    # paths are stored relative to the folder containing the output directory
+    root = os.path.dirname(os.path.dirname(os.path.abspath(catalog)))
+    return os.path.relpath(os.path.abspath(savedpath), root)
+
+
+def _find_catalog(savedpath: str) -> Union[str or None]:
+    path = os.path.abspath(savedpath)
+    while True:
+        catalog = os.path.join(path, CATALOG_FILE)
+        if os.path.exists(catalog):
+            return catalog
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
@@ -10,6 +10,7 @@ from typing import Union
 from pathlib import Path
 import os
 import gin
+from utils.catalog import register_run, update_run
 
 # yaml is bugged and not able to read float written in scientific notation
 # for info look at https://stackoverflow.com/questions/30458977/yaml-loads-5e-6-as-string-and-not-a-number
@@ -151,7 +152,8 @@ def GeneratePathFolder(
     Returns
     -------
     savedpath: str
-        The path until the outputModel subdirectory
+        The path until the outputModel subdirectory. The run is also registered
+        in the catalog of outputDir
 
     """
 
@@ -194,6 +196,15 @@ def GeneratePathFolder(
                 # sys.exit("Folder already exists. This experiment has already been run.")
                 pass
 
+    register_run(
+        savedpath,
+        outputDir,
+        outputClass,
+        outputModel,
+        format_tousands(N_train),
+        hyperparams={v: gin.query_parameter(v) for v in varying_pars or []},
+    )
+
     return savedpath
 
 
@@ -288,6 +299,20 @@ def save(config, path):
         file.write(yaml.dump(config))
 
 
-def save_gin(destination: Path):
+def save_gin(destination: Path, seed: int = None, checkpoints: list = None):
+    """Save the operative gin config of a run and record the run outputs in the
+    experiment catalog.
+
+    Parameters
+    ----------
+    destination: Path
+        Path of the config file, inside the folder of the run
+    seed: int, optional
+        Seed of the run
+    checkpoints: list, optional
+        Checkpoints at which the agent has been saved and tested
+    """
+    config = gin.operative_config_str()
     with open(destination, "w") as f:
-        f.write(gin.operative_config_str())
+        f.write(config)
+    update_run(os.path.dirname(destination), config, seed, checkpoints)
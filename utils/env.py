@@ -2,11 +2,15 @@ from typing import Union, Tuple
 import pandas as pd
 import numpy as np
 import pdb, os
+import copy
 import gym
 import gin
 import sys
-from utils.math_tools import unscale_action
+from scipy.signal import lfilter
+from utils.math_tools import unscale_action, CorrelationSpec
 from utils.common import format_tousands
+from utils.results import ResultStore
+from utils.spaces import DiscreteGrid
 
 
 @gin.configurable()
@@ -63,8 +67,41 @@ class MarketEnv(gym.Env):
         Series of datetime values if real values are used within the environment,
         otherwise it is just a serie of integer number of length N_train
 
+    corr: Union[float or list or dict] = None
+        Correlation of the assets in a multi asset environment, given as a
+        constant, as the flat list of pairwise correlations or as a structured
+        (block, factor or sparse) specification. See CorrelationSpec
+
+    cov_rank: int = None
+        Rank of the low rank plus diagonal representation of the covariance of a
+        multi asset environment. If None the dense covariance matrix is kept
+
+    corr_spec: CorrelationSpec
+        Validated correlation specification, with the compact encoding of the
+        correlation used as input of the agents
+
+    cov: FactorizedCovariance
+        Covariance of the assets with its cached factorization
+
+    cov_matrix: np.ndarray
+        Dense covariance matrix of the assets, built on access when the low rank
+        representation is used
+
+    holding_ts: np.ndarray
+        Preallocated history of holdings of the cash environments, of shape
+        (T+1,) or (T+1, n_assets), overwritten at each episode
+
+    cash_ts: np.ndarray
+        Preallocated history of cash of the cash environments, of shape (T+1,)
+
+    ts_cursor: int
+        Number of entries of holding_ts and cash_ts written in the current episode
+
+    results: ResultStore
+        Preallocated float32 buffer which stores results of relevant quantities
+
     res_df: pd.Dataframe
-        Dataframe which store results of relevant quantities
+        Dataframe view of the stored results, built on access
 
     Methods
     -------
@@ -95,10 +132,26 @@ class MarketEnv(gym.Env):
             tag: str = 'MV') -> Tuple[np.ndarray,dict]:
         Counterpart of step method used for the Markovitz solution
 
+    opt_trajectory(OptRate: float, DiscFactorLoads: np.ndarray, n_steps: int = None,
+                   tag: str = 'Opt') -> dict
+        Compute the whole benchmark trajectory in one vectorized pass. It returns
+        the same quantities of opt_step as arrays with one entry per step
+
+    mv_trajectory(n_steps: int = None, tag: str = 'MV') -> dict
+        Vectorized counterpart of mv_step over the whole series
+
+    observation_matrix(holdings: np.ndarray = None, cash: np.ndarray = None,
+                       n_steps: int = None) -> np.ndarray
+        Build the (T, d) matrix of the states visited along a fixed trajectory
+
     store_results(Result:dict, iteration: int)
-        Store dictionary of current results to the DataFrame saved as attribute
+        Store dictionary of current results to the result buffer saved as attribute
         of the class
 
+    store_trajectory(Result:dict, start: int = 0)
+        Store a dictionary of result arrays (e.g. the output of opt_trajectory)
+        to the result buffer starting from the row given by start
+
     save_outputs(self, savedpath, test=None, iteration=None, include_dates=False)
         Save the DataFrame saved as attribute of the class in a parquet format
 
@@ -115,6 +168,9 @@ class MarketEnv(gym.Env):
     _find_nearest_holding(value) -> Union[float or int]
         Get the discretized counterpart of the holding (value)
 
+    _get_grid(space_name: str) -> DiscreteGrid
+        Get the sorted grid of the given discretized space, built once per space
+
     _totalcost(shares_traded: Union[float or int]) -> Union[float or int]
         Compute transaction cost for the given trade
 
@@ -152,6 +208,7 @@ class MarketEnv(gym.Env):
         multiasset: bool = False,
         corr: int = None,
         inputs: list = None,
+        cov_rank: int = None,
     ):
 
         # super(MarketEnv, self).__init__()
@@ -178,61 +235,58 @@ class MarketEnv(gym.Env):
         self.corr = corr
         self.cash = cash
         self.inputs = inputs
+        self.cov_rank = cov_rank
         
         if multiasset:
             colnames = (["returns" + str(hl) for hl in HalfLife] + 
             ["factor_" + str(h) for hl in HalfLife for h in hl])
-            
-            res_df = pd.DataFrame(
-                np.concatenate(
-                    [np.array(self.returns), np.array(self.factors)], axis=1
-                ),
-                columns=colnames,
+            res_data = np.concatenate(
+                [np.array(self.returns), np.array(self.factors)], axis=1
             )
             self.n_assets = len(HalfLife)
             self.n_factors = len(HalfLife[0])
             if self.cash:
     
-                self.holding_ts = [[self.Startholding]*self.n_assets]
-                self.cash_ts = [cash]
+                self._allocate_ts((self.n_assets,))
                 self.traded_amount = 0.0
                 self.costs = 0.0
             
-            if isinstance(self.corr,float):
-                cov_matrix = np.eye(self.n_assets,self.n_assets) * self.sigma**2
-                cov_matrix[cov_matrix==0] = self.corr * self.sigma**2 
-            elif isinstance(self.corr,list):
-                cov_matrix = np.zeros((self.n_assets,self.n_assets))
-                cov_matrix[np.triu_indices(cov_matrix.shape[0], k = 1)] = np.array(self.corr) * self.sigma**2
-                cov_matrix = cov_matrix + cov_matrix.T
-                cov_matrix[np.where(cov_matrix==0)] = self.sigma**2
-            if np.allclose(cov_matrix, cov_matrix.T):
-                self.cov_matrix = cov_matrix
-            else:
-                print('Created a Covariance matrix which is not symmetric!')
-                sys.exit()
+            # correlation specification validated once and covariance factorized
+            self.corr_spec = CorrelationSpec(self.corr, self.n_assets)
+            self.cov = self.corr_spec.covariance(self.sigma, self.cov_rank)
+            if self.inp_type == "alpha":
+                # Markowitz aim of the alpha inputs, inverted once instead of at
+                # each step (the dense matrix is built only here)
+                self._alpha_inv = np.linalg.inv(self.cov_matrix ** self.kappa)
 
         else:
 
             colnames = ["returns"] + ["factor_" + str(hl) for hl in HalfLife]
-
-            res_df = pd.DataFrame(
-                np.concatenate(
-                    [np.array(self.returns).reshape(-1, 1), np.array(self.factors)], axis=1
-                ),
-                columns=colnames,
+            res_data = np.concatenate(
+                [np.array(self.returns).reshape(-1, 1), np.array(self.factors)], axis=1
             )
             if cash:
                 self.cash = cash
-                self.holding_ts = [self.Startholding]
-                self.cash_ts = [cash]
+                self._allocate_ts(())
                 self.traded_amount = 0.0
                 self.costs = 0.0
 
         self.dates = dates
-        res_df = res_df.astype(np.float32)
-        self.res_df = res_df
-        
+        # preallocated state buffer built at the first call of _get_inputs
+        self._state, self._state_slices = None, None
+        # sorted discretization grids of returns_space and holding_space
+        self._grids = {}
+        # results are written step by step in a preallocated float32 buffer and
+        # converted to a DataFrame only when res_df is accessed
+        self.results = ResultStore(len(res_data), data=res_data, colnames=colnames)
+
+    @property
+    def res_df(self) -> pd.DataFrame:
+        return self.results.to_frame()
+
+    @property
+    def cov_matrix(self) -> np.ndarray:
+        return self.cov.dense()
 
     def get_state_dim(self):
         state = self.reset()
@@ -257,11 +311,15 @@ class MarketEnv(gym.Env):
         nextFactors = self.factors[iteration + 1]
         nextRet = self.returns[iteration + 1]
 
-        nextHolding = currState[-1] + shares_traded
+        # elementwise, so that states of shape (n_envs, d) with the series
+        # stacked time major step all the environments at once
+        nextHolding = currState[..., -1] + shares_traded
         if self.inp_type == "ret":
-            nextState = np.array([nextRet, nextHolding], dtype=np.float32)
+            nextState = np.stack([nextRet, nextHolding], axis=-1).astype(np.float32)
         elif self.inp_type == "f":
-            nextState = np.append(nextFactors, nextHolding)
+            nextState = np.concatenate(
+                [nextFactors, np.expand_dims(nextHolding, -1)], axis=-1
+            )
 
         Result = self._getreward(currState, nextState, iteration, tag)
 
@@ -275,27 +333,29 @@ class MarketEnv(gym.Env):
         tag: str = "DQN",
     ) -> Tuple[np.ndarray, dict, np.ndarray]:
 
-        CurrHolding = currState[-1]
+        CurrHolding = currState[..., -1]
         if self.inp_type == 'alpha':
-            curr_alpha = currState[0]
+            curr_alpha = currState[..., 0]
             # Traded quantity as for the Markovitz framework  (Mean-Variance framework)
             OptNextHolding = (1 / (self.kappa * (self.sigma) ** 2)) * curr_alpha
         else:
             CurrFactors = self.factors[iteration]
             # Traded quantity as for the Markovitz framework  (Mean-Variance framework)
             OptNextHolding = (1 / (self.kappa * (self.sigma) ** 2)) * np.sum(
-                self.f_param * CurrFactors
+                self.f_param * CurrFactors, axis=-1
             )
             nextFactors = self.factors[iteration + 1]
         # Compute optimal markovitz action
         MV_action = OptNextHolding - CurrHolding
 
         nextRet = self.returns[iteration + 1]
-        nextHolding = currState[-1] + MV_action * (1 - shares_traded)
+        nextHolding = CurrHolding + MV_action * (1 - shares_traded)
         if self.inp_type == "ret" or self.inp_type == "alpha":
-            nextState = np.array([nextRet, nextHolding], dtype=np.float32)
+            nextState = np.stack([nextRet, nextHolding], axis=-1).astype(np.float32)
         elif self.inp_type == "f" or self.inp_type == "alpha_f":
-            nextState = np.append(nextFactors, nextHolding)
+            nextState = np.concatenate(
+                [nextFactors, np.expand_dims(nextHolding, -1)], axis=-1
+            )
 
         Result = self._getreward(
             currState, nextState, iteration, tag, res_action=shares_traded
@@ -376,70 +436,72 @@ class MarketEnv(gym.Env):
 
         return nextOptState, OptResult
 
+    def opt_trajectory(
+        self,
+        OptRate: float,
+        DiscFactorLoads: np.ndarray,
+        n_steps: int = None,
+        tag: str = "Opt",
+    ) -> dict:
+
+        if n_steps is None:
+            n_steps = len(self.returns) - 1
+        factors = np.asarray(self.factors)[:n_steps]
+        nextReturns = np.asarray(self.returns)[1 : n_steps + 1]
+
+        # Markovitz portfolio at each step, discounted as for the GP solution
+        OptAim = (1 / (self.kappa * (self.sigma) ** 2)) * np.sum(
+            DiscFactorLoads * factors, axis=1
+        )
+        # h_{t+1} = (1 - OptRate) * h_t + OptRate * aim_t solved as a linear filter
+        OptNextHolding = lfilter(
+            [OptRate],
+            [1.0, -(1 - OptRate)],
+            OptAim,
+            zi=[(1 - OptRate) * self.Startholding],
+        )[0]
+        OptCurrHolding = np.append(self.Startholding, OptNextHolding[:-1])
+
+        return self._get_opt_reward(
+            (None, None, OptCurrHolding), (nextReturns, None, OptNextHolding), tag
+        )
+
+    def mv_trajectory(self, n_steps: int = None, tag: str = "MV") -> dict:
+
+        if n_steps is None:
+            n_steps = len(self.returns) - 1
+        factors = np.asarray(self.factors)[:n_steps]
+        nextReturns = np.asarray(self.returns)[1 : n_steps + 1]
+
+        # Traded quantity as for the Markovitz framework  (Mean-Variance framework)
+        OptNextHolding = (1 / (self.kappa * (self.sigma) ** 2)) * np.sum(
+            self.f_param * factors, axis=1
+        )
+        OptCurrHolding = np.append(self.Startholding, OptNextHolding[:-1])
+
+        return self._get_opt_reward(
+            (None, None, OptCurrHolding), (nextReturns, None, OptNextHolding), tag
+        )
+
     def store_results(self, Result: dict, iteration: int):
-        if iteration == 0:
-            for key in Result.keys():
-                if isinstance(Result[key],list) or isinstance(Result[key],np.ndarray):
-                    for i,k in enumerate(Result[key]):
-                        self.res_df[key+'_{}'.format(i)] = 0.0
-                        self.res_df.at[iteration, key+'_{}'.format(i)] = k
-                else:
-                    self.res_df[key] = 0.0
-                    self.res_df.at[iteration, key] = Result[key]
-            self.res_df = self.res_df.astype(np.float32)
-        else:
+        self.results.store(Result, iteration)
 
-            for key in Result.keys():
-                if isinstance(Result[key],list) or isinstance(Result[key],np.ndarray):
-                    name = key
-                    suffixes = ['_{}'.format(i) for i in range(len(Result[key]))] 
-                    names = [name + s for s in suffixes]
-                    self.res_df.loc[iteration,names] = Result[key]
-                else:
-                    self.res_df.at[iteration, key] = Result[key]
+    def store_trajectory(self, Result: dict, start: int = 0):
+        self.results.store_series(Result, start)
 
     def save_outputs(self, savedpath, test=None, iteration=None, include_dates=False):
 
+        res_df = self.res_df
+        if include_dates:
+            res_df = res_df.assign(date=self.dates)
+
         if not test:
-            if include_dates:
-                self.res_df["date"] = self.dates
-                self.res_df.to_parquet(
-                    os.path.join(
-                        savedpath,
-                        "Results_{}.parquet.gzip".format(format_tousands(self.N_train)),
-                    ),
-                    compression="gzip",
-                )
-            else:
-                self.res_df.to_parquet(
-                    os.path.join(
-                        savedpath,
-                        "Results_{}.parquet.gzip".format(format_tousands(self.N_train)),
-                    ),
-                    compression="gzip",
-                )
+            filename = "Results_{}.parquet.gzip".format(format_tousands(self.N_train))
         else:
-            if include_dates:
-                self.res_df["date"] = self.dates
-                self.res_df.to_parquet(
-                    os.path.join(
-                        savedpath,
-                        "TestResults_{}_iteration_{}.parquet.gzip".format(
-                            format_tousands(self.N_train), iteration
-                        ),
-                    ),
-                    compression="gzip",
-                )
-            else:
-                self.res_df.to_parquet(
-                    os.path.join(
-                        savedpath,
-                        "TestResults_{}_iteration_{}.parquet.gzip".format(
-                            format_tousands(self.N_train), iteration
-                        ),
-                    ),
-                    compression="gzip",
-                )
+            filename = "TestResults_{}_iteration_{}.parquet.gzip".format(
+                format_tousands(self.N_train), iteration
+            )
+        res_df.to_parquet(os.path.join(savedpath, filename), compression="gzip")
 
     def opt_trading_rate_disc_loads(self) -> Tuple[float, np.ndarray]:
 
@@ -464,14 +526,19 @@ class MarketEnv(gym.Env):
 
     # PRIVATE METHODS
     def _find_nearest_return(self, value) -> float:
-        array = np.asarray(self.returns_space.values)
-        idx = (np.abs(array - value)).argmin()
-        return array[idx]
+        return self._get_grid("returns_space").nearest(value)
 
     def _find_nearest_holding(self, value) -> Union[float or int]:
-        array = np.asarray(self.holding_space.values)
-        idx = (np.abs(array - value)).argmin()
-        return array[idx]
+        return self._get_grid("holding_space").nearest(value)
+
+    def _get_grid(self, space_name: str) -> DiscreteGrid:
+        # the sorted grid is rebuilt only when a new space is assigned
+        space = getattr(self, space_name)
+        cached = self._grids.get(space_name)
+        if cached is None or cached[0] is not space:
+            cached = (space, DiscreteGrid(space.values))
+            self._grids[space_name] = cached
+        return cached[1]
 
     def _totalcost(self, shares_traded: Union[float or int]) -> Union[float or int]:
         if self.cost_type == 'quadratic':
@@ -499,8 +566,8 @@ class MarketEnv(gym.Env):
         # currRet = currState[0]
 
         nextRet = self.returns[iteration + 1]
-        currHolding = currState[-1]
-        nextHolding = nextState[-1]
+        currHolding = currState[..., -1]
+        nextHolding = nextState[..., -1]
 
         shares_traded = nextHolding - currHolding
         GrossPNL = nextHolding * nextRet
@@ -521,7 +588,8 @@ class MarketEnv(gym.Env):
             "Cost_{}".format(tag): Cost,
             "Reward_{}".format(tag): Reward,
         }
-        if res_action:
+        # written also when zero, so that the columns keep the same order
+        if res_action is not None:
             Result["ResAction_{}".format(tag)] = res_action
         
         if self.reward_type == 'mean_var': 
@@ -568,55 +636,155 @@ class MarketEnv(gym.Env):
         return Result
 
 
-    def _get_inputs(self,reset,iteration=None):
+    def _allocate_ts(self, shape: tuple, batch_shape: tuple = ()):
+        # one row for the initial state and one for each step on the series,
+        # each row holding batch_shape environments when their series are stacked
+        length = len(self.returns) + 1
+        self.holding_ts = np.empty((length,) + batch_shape + shape)
+        self.cash_ts = np.empty((length,) + batch_shape)
+        self._reset_ts()
+
+    def _reset_ts(self):
+        # histories are overwritten in place at each episode
+        self.holding_ts[0] = self.Startholding
+        self.cash_ts[0] = self.cash
+        self.ts_cursor = 1
+
+    def _store_ts(self, index: int, holding: Union[float or np.ndarray], cash: float):
+        if index >= len(self.cash_ts):
+            self._grow_ts(2 * index)
+        self.holding_ts[index] = holding
+        self.cash_ts[index] = cash
+        self.ts_cursor = index + 1
+
+    def _grow_ts(self, length: int):
+        holding_ts = np.empty((length,) + self.holding_ts.shape[1:])
+        holding_ts[: len(self.holding_ts)] = self.holding_ts
+        cash_ts = np.empty((length,) + self.cash_ts.shape[1:])
+        cash_ts[: len(self.cash_ts)] = self.cash_ts
+        self.holding_ts, self.cash_ts = holding_ts, cash_ts
+
+    def _get_inputs(self, reset: bool, iteration: int = None) -> np.ndarray:
+        # the static part of the state (sigma, correlations) is written once in a
+        # preallocated buffer and only the dynamic slices are overwritten here
+        if self._state_slices is None:
+            self._build_state_layout()
+        state, slices = self._state, self._state_slices
 
-        # could be rewritten better https://stackoverflow.com/questions/25211924/check-every-condition-in-python-if-else-even-if-one-evaluates-to-true
-        input_list = []
-        input_type= self.inputs
         if reset:
-            if self.inp_type == "ret" or self.inp_type == "alpha":
-                input_list.extend(list(self.returns[0]))
-            elif self.inp_type == "f" or self.inp_type == "alpha_f":
-                input_list.extend(list(self.factors[0]))
-
-            if "sigma" in input_type:
-                input_list.append(self.sigma**2)
-            if "corr" in input_type:
-                if isinstance(self.corr,float):
-                    input_list.append(self.corr)
-                elif isinstance(self.corr,list):
-                    input_list.extend(self.corr)
-            if "holding" in input_type:
-                input_list.extend([self.Startholding]*self.n_assets)
-            # entire arrays
-            if "cash" in input_type:
-                input_list.append(self.cash)
+            if "market" in slices:
+                state[..., slices["market"]] = self._market_inputs(0)
+            if "holding" in slices:
+                state[..., slices["holding"]] = self.Startholding
+            if "cash" in slices:
+                state[..., slices["cash"]] = self.cash
         else:
-            if self.inp_type == "ret" or self.inp_type == "alpha":
-                input_list.extend(list(self.returns[iteration+1]))
-            elif self.inp_type == "f" or self.inp_type == "alpha_f":
-                input_list.extend(list(self.factors[iteration+1]))
-
-            if "sigma" in input_type:
-                input_list.append(self.sigma**2)
-            if "corr" in input_type:
-                if isinstance(self.corr,float):
-                    input_list.append(self.corr)
-                elif isinstance(self.corr,list):
-                    input_list.extend(self.corr)
-            if "holding" in input_type:
-                input_list.extend(self.holding_ts[iteration+1])
-            # entire arrays
-            if "cash" in input_type:
-                input_list.append(self.cash_ts[iteration+1])
-
-        return input_list
+            if "market" in slices:
+                state[..., slices["market"]] = self._market_inputs(iteration + 1)
+            if "holding" in slices:
+                state[..., slices["holding"]] = self.holding_ts[iteration + 1]
+            if "cash" in slices:
+                state[..., slices["cash"]] = np.expand_dims(
+                    self.cash_ts[iteration + 1], -1
+                )
+
+        return state
+
+    def _market_inputs(self, index: Union[int or slice]) -> np.ndarray:
+        if self.inp_type == "ret" or self.inp_type == "alpha":
+            return np.asarray(self.returns)[index]
+        elif self.inp_type == "f" or self.inp_type == "alpha_f":
+            return np.asarray(self.factors)[index]
+
+    def _build_state_layout(self, batch_shape: tuple = ()):
+        # batch_shape leading dimensions of the buffer when the series of
+        # several environments are stacked
+        input_type = self.inputs
+        parts = []
+        if self._market_inputs(0) is not None:
+            market_shape = np.shape(self._market_inputs(0))[len(batch_shape) :]
+            parts.append(("market", int(np.prod(market_shape)), None))
+        if "sigma" in input_type:
+            parts.append(("sigma", 1, self.sigma ** 2))
+        if "corr" in input_type and self.corr is not None:
+            parts.append(("corr", len(self.corr_spec.state), self.corr_spec.state))
+        if "holding" in input_type:
+            parts.append(("holding", self.n_assets, None))
+        if "cash" in input_type:
+            parts.append(("cash", 1, None))
+
+        self._state = np.zeros(
+            batch_shape + (sum(size for _, size, _ in parts),), dtype=np.float32
+        )
+        self._state_slices = {}
+        start = 0
+        for name, size, value in parts:
+            self._state_slices[name] = slice(start, start + size)
+            if value is not None:
+                self._state[..., start : start + size] = value
+            start += size
+
+    def observation_matrix(
+        self,
+        holdings: np.ndarray = None,
+        cash: np.ndarray = None,
+        n_steps: int = None,
+    ) -> np.ndarray:
+        """
+        Build in one shot the (T, d) matrix of the states visited along a fixed
+        trajectory, where row t is the state returned by reset (t=0) or by the
+        step at iteration t-1.
+
+        Parameters
+        ----------
+        holdings: np.ndarray
+            Holdings of shape (T, n_assets) along the trajectory. If None the
+            holdings stored by the environment are used
+
+        cash: np.ndarray
+            Cash of shape (T,) along the trajectory. If None the cash stored by
+            the environment is used
+
+        n_steps: int
+            Number of states T. If None it is inferred from the holdings
+
+        Returns
+        ----------
+        observations: np.ndarray
+            Matrix of states of shape (T, d)
+
+        """
+        if self._state_slices is None:
+            self._build_state_layout()
+        slices = self._state_slices
+        if holdings is None and "holding" in slices:
+            holdings = self.holding_ts[: self.ts_cursor]
+        if cash is None and "cash" in slices:
+            cash = self.cash_ts[: self.ts_cursor]
+        if n_steps is None:
+            n_steps = len(holdings) if holdings is not None else len(cash)
+
+        # static parts are broadcast from the state buffer
+        observations = np.tile(self._state, (n_steps, 1))
+        if "market" in slices:
+            observations[:, slices["market"]] = np.reshape(
+                self._market_inputs(slice(0, n_steps)), (n_steps, -1)
+            )
+        if "holding" in slices:
+            observations[:, slices["holding"]] = np.reshape(
+                holdings[:n_steps], (n_steps, -1)
+            )
+        if "cash" in slices:
+            observations[:, slices["cash"]] = np.reshape(cash[:n_steps], (n_steps, 1))
+
+        return observations
 
 
 @gin.configurable()
 class CashMarketEnv(MarketEnv):
 
     def reset(self) -> Tuple[np.ndarray, np.ndarray]:
+        self._reset_ts()
         if self.inp_type == "ret" or self.inp_type == "alpha":
             currState = np.array([self.returns[0], self.Startholding, self.cash])
             return currState
@@ -647,9 +815,8 @@ class CashMarketEnv(MarketEnv):
 
         # update rules
         nextHolding = (1+nextRet) * self.holding_ts[iteration] + shares_traded
-        self.holding_ts.append(nextHolding)
         nextCash = self.cash_ts[iteration] + self.traded_amount
-        self.cash_ts.append(nextCash)
+        self._store_ts(iteration + 1, nextHolding, nextCash)
 
         if self.inp_type == "ret":
             nextState = np.array([nextRet, nextHolding, nextCash], dtype=np.float32)
@@ -686,9 +853,8 @@ class CashMarketEnv(MarketEnv):
         nextRet = self.returns[iteration + 1]
 
         nextHolding = (1+nextRet) * CurrHolding + MV_action * (1 - shares_traded)
-        self.holding_ts.append(nextHolding)
         nextCash = self.cash_ts[iteration] + self.traded_amount
-        self.cash_ts.append(nextCash)
+        self._store_ts(iteration + 1, nextHolding, nextCash)
 
         if self.inp_type == "ret" or self.inp_type == "alpha":
             nextState = np.array([nextRet, nextHolding,nextCash], dtype=np.float32)
@@ -740,6 +906,56 @@ class CashMarketEnv(MarketEnv):
 
         return nextOptState, OptResult
 
+    def opt_trajectory(
+        self,
+        OptRate: float,
+        DiscFactorLoads: np.ndarray,
+        n_steps: int = None,
+        tag: str = "Opt",
+    ) -> dict:
+
+        if n_steps is None:
+            n_steps = len(self.returns) - 1
+        factors = np.asarray(self.factors)[:n_steps]
+        nextReturns = np.asarray(self.returns)[1 : n_steps + 1]
+
+        OptAim = (1 / (self.kappa * (self.sigma) ** 2)) * np.sum(
+            DiscFactorLoads * factors, axis=1
+        )
+
+        # trades are clipped by the available cash and holding, so the recursion
+        # is not linear and only the trade execution is kept step by step
+        OptHolding = np.empty(n_steps + 1)
+        OptCash = np.empty(n_steps + 1)
+        OptCost = np.empty(n_steps)
+        OptTradedAmount = np.empty(n_steps)
+        OptHolding[0], OptCash[0] = self.Startholding, self.cash
+        for t in range(n_steps):
+            action = OptRate * (OptAim[t] - OptHolding[t])
+            OptHolding[t + 1] = self._opt_trade(
+                index=t, state=(None, OptHolding[t], OptCash[t]), action=action
+            )
+            OptCost[t], OptTradedAmount[t] = self.costs, self.traded_amount
+            OptCash[t + 1] = OptCash[t] + self.traded_amount
+
+        OptNextHolding = OptHolding[1:]
+        OptNetPNL = OptNextHolding * nextReturns - OptCost
+        OptRisk = 0.5 * self.kappa * ((OptNextHolding) ** 2 * (self.sigma) ** 2)
+
+        Result = {
+            "{}NextAction".format(tag): OptNextHolding - OptHolding[:-1],
+            "{}NextHolding".format(tag): OptNextHolding,
+            "{}GrossPNL".format(tag): OptNetPNL + OptCost,
+            "{}NetPNL".format(tag): OptNetPNL,
+            "{}Risk".format(tag): OptRisk,
+            "{}Cost".format(tag): OptCost,
+            "{}Reward".format(tag): OptNetPNL - OptRisk,
+            "{}TradedAmount".format(tag): OptTradedAmount,
+            "{}Cash".format(tag): OptCash[1:],
+            "{}Wealth".format(tag): OptNextHolding + OptCash[1:],
+        }
+
+        return Result
 
     def _getreward(
         self,
@@ -777,6 +993,84 @@ class CashMarketEnv(MarketEnv):
             Result["ResAction_{}".format(tag)] = res_action
         return Result
 
+    def _execute_trades(
+        self,
+        holding: np.ndarray,
+        cash: float,
+        action: np.ndarray,
+        opt: bool = False,
+    ) -> np.ndarray:
+        """
+        Vectorized counterpart of _buy/_sell (or _opt_trade when opt is True)
+        applied to all the assets at once. Buys are limited by the available
+        cash and sells by the current holdings, since short selling is not allowed.
+
+        Parameters
+        ----------
+        holding: np.ndarray
+            Current holdings of all the assets, as (n_envs, n_assets) when the
+            environments are stacked
+
+        cash: float
+            Cash available before the trades, as (n_envs,) when the
+            environments are stacked
+
+        action: np.ndarray
+            Desired trade of each asset
+
+        opt: bool
+            Apply the trading rules of the benchmark agent
+
+        Returns
+        ----------
+        shares_traded: np.ndarray
+            Executed trade of each asset
+
+        """
+        action = np.asarray(action, dtype=float)
+        holding = np.asarray(holding, dtype=float)
+
+        buy = action > 0.0
+        sell = (action < 0.0) & (holding > 0.0)
+        cash = np.expand_dims(cash, -1)
+        shares_traded = np.where(buy, np.minimum(cash, action), 0.0)
+        shares_traded = np.where(
+            sell, -np.minimum(np.abs(action), holding), shares_traded
+        )
+
+        # the benchmark restarts the running costs at every sell
+        reset_before = sell if opt else np.zeros_like(sell)
+        self._accumulate_costs(shares_traded, ~(buy | sell), reset_before)
+
+        return shares_traded
+
+    def _accumulate_costs(
+        self,
+        shares_traded: np.ndarray,
+        reset_after: np.ndarray,
+        reset_before: np.ndarray,
+    ):
+        # Reproduce the running self.costs and self.traded_amount of the asset
+        # by asset execution, where the traded amount of each asset is net of
+        # the costs accumulated so far. Both restart from zero after the assets
+        # in reset_after (holds or sells without holdings) and before the ones
+        # in reset_before, so only the assets after the last restart count.
+        # Stacked environments (rows) restart independently.
+        assets = np.arange(shares_traded.shape[-1])
+        start = np.maximum(
+            np.max(np.where(reset_after, assets + 1, 0), axis=-1),
+            np.max(np.where(reset_before, assets, 0), axis=-1),
+        )
+        counted = assets >= np.expand_dims(start, -1)
+
+        costs = np.cumsum(
+            np.where(counted, self._totalcost(shares_traded), 0.0), axis=-1
+        )
+        self.costs = costs[..., -1]
+        self.traded_amount = np.sum(
+            np.where(counted, -shares_traded - costs, 0.0), axis=-1
+        )
+
     def _sell(self, index: int, holding: np.ndarray, action: float):
 
         currholding = holding
@@ -940,8 +1234,9 @@ class ShortCashMarketEnv(CashMarketEnv):
 class MultiAssetCashMarketEnv(CashMarketEnv):
 
     def reset(self) -> Tuple[np.ndarray, np.ndarray]:
-        input_list = self._get_inputs(reset=True)
-        currState = np.array(input_list).reshape(-1,)  # long vector
+        self._reset_ts()
+        # copy of the state buffer, since the buffer is overwritten at each step
+        currState = self._get_inputs(reset=True).copy()
         return currState
 
 
@@ -967,9 +1262,8 @@ class MultiAssetCashMarketEnv(CashMarketEnv):
 
         # update rules
         nextHolding = (1+nextRet) * self.holding_ts[iteration] + shares_traded
-        self.holding_ts.append(nextHolding)
         nextCash = self.cash_ts[iteration] + self.traded_amount
-        self.cash_ts.append(nextCash)
+        self._store_ts(iteration + 1, nextHolding, nextCash)
 
         if self.inp_type == "ret":
             nextState = np.array([nextRet, nextHolding, nextCash], dtype=np.float32)
@@ -990,48 +1284,35 @@ class MultiAssetCashMarketEnv(CashMarketEnv):
         
         CurrHolding = np.array(self.holding_ts[iteration])
         if self.inp_type == 'alpha':
-            curr_alpha = np.array(currState[:self.n_assets])
+            curr_alpha = np.array(currState[..., :self.n_assets])
             # Traded quantity as for the Markovitz framework  (Mean-Variance framework)
-            OptNextHolding = np.dot(np.linalg.inv(self.cov_matrix** self.kappa), curr_alpha)
+            OptNextHolding = np.dot(curr_alpha, self._alpha_inv.T)
         else:
-            CurrFactors = self.factors[iteration].reshape(self.n_assets,self.n_factors)
+            CurrFactors = self.factors[iteration]
+            CurrFactors = CurrFactors.reshape(
+                CurrFactors.shape[:-1] + (self.n_assets, self.n_factors)
+            )
             # Traded quantity as for the Markovitz framework  (Mean-Variance framework)
-            OptNextHolding = np.dot(np.linalg.inv(self.cov_matrix* self.kappa), np.dot(
-                CurrFactors,self.f_param[0]
-            )) 
+            OptNextHolding = self.cov.solve(np.dot(CurrFactors,self.f_param[0])) / self.kappa
             nextFactors = self.factors[iteration + 1]
         # Compute optimal markovitz action
         MV_action = OptNextHolding - CurrHolding
         MV_res_action = MV_action * (1-shares_traded)
 
-        # buy/sell here
-        res_shares_traded = []
-        for i,a in enumerate(MV_res_action):
-            if a > 0:
-                trade = self._buy(
-                    index=iteration, cash=currState[-1], action=a
-                )
-            elif a < 0:
-                trade = self._sell(
-                    index=iteration, holding=currState[-1-self.n_assets+i], action=a
-                )
-            else:
-                trade = 0.0
-                self.costs, self.traded_amount = 0.0, 0.0
-            res_shares_traded.append(trade)
-        res_shares_traded = np.array(res_shares_traded)
-        
+        # buy/sell here, from the float64 histories rather than the float32 state
+        res_shares_traded = self._execute_trades(
+            holding=CurrHolding, cash=self.cash_ts[iteration], action=MV_res_action
+        )
+
 
         nextRet = self.returns[iteration + 1]
 
         nextHolding = (1+nextRet) * CurrHolding + res_shares_traded
-        self.holding_ts.append(nextHolding)
         nextCash = self.cash_ts[iteration] + self.traded_amount
-        self.cash_ts.append(nextCash)
+        self._store_ts(iteration + 1, nextHolding, nextCash)
 
 
-        input_list = self._get_inputs(reset=False,iteration=iteration)
-        nextState = np.array(input_list).reshape(-1,)  # long vector
+        nextState = self._get_inputs(reset=False,iteration=iteration).copy()
             
         Result = self._getreward(
             iteration, tag, res_action=res_shares_traded
@@ -1057,20 +1338,15 @@ class MultiAssetCashMarketEnv(CashMarketEnv):
         OptCurrHolding = np.array(currOptState[-1-self.n_assets:-1])
         # Optimal traded quantity between period
         DiscFactors = CurrFactors/ (1+self.f_speed * ((OptRate * self.CostMultiplier) / self.kappa))
-        OptNextHolding = np.dot(np.linalg.inv(self.cov_matrix* self.kappa), np.dot(
-            DiscFactors,self.f_param[0]
-        ))
+        OptNextHolding = self.cov.solve(np.dot(DiscFactors,self.f_param[0])) / self.kappa
         
         action = OptNextHolding - OptCurrHolding
 
         # buy/sell here
-        OptTrades = []
-        for i,a in enumerate(action):
-            opt_t = self._opt_trade(
-                index=iteration, holding=currOptState[-1-self.n_assets+i], cash=currOptState[-1], action=a
-            )
-            OptTrades.append(opt_t)
-        OptNextHolding = np.array(OptTrades)  + OptCurrHolding * (1 + self.returns[iteration+1])
+        OptTrades = self._execute_trades(
+            holding=OptCurrHolding, cash=currOptState[-1], action=action, opt=True
+        )
+        OptNextHolding = OptTrades + OptCurrHolding * (1 + self.returns[iteration+1])
         
         nextCash = currOptState[-1] + self.traded_amount
         nextReturn = self.returns[iteration + 1]
@@ -1083,6 +1359,65 @@ class MultiAssetCashMarketEnv(CashMarketEnv):
 
         return nextOptState, OptResult
 
+    def opt_trajectory(
+        self,
+        OptRate: float,
+        DiscFactorLoads: np.ndarray,
+        n_steps: int = None,
+        tag: str = "Opt",
+    ) -> dict:
+
+        if n_steps is None:
+            n_steps = len(self.returns) - 1
+        factors = np.asarray(self.factors)[:n_steps].reshape(
+            n_steps, self.n_assets, self.n_factors
+        )
+        nextReturns = np.asarray(self.returns)[1 : n_steps + 1]
+
+        # target portfolios for all the steps with the cached factorization
+        DiscFactors = factors / (
+            1 + self.f_speed * ((OptRate * self.CostMultiplier) / self.kappa)
+        )
+        OptAim = self.cov.solve(np.dot(DiscFactors, self.f_param[0])) / self.kappa
+
+        # trades are clipped by the available cash and holding, so the recursion
+        # is not linear and only the trade execution is kept step by step
+        OptHolding = np.empty((n_steps + 1, self.n_assets))
+        OptCash = np.empty(n_steps + 1)
+        OptCost = np.empty(n_steps)
+        OptTradedAmount = np.empty(n_steps)
+        OptHolding[0], OptCash[0] = self.Startholding, self.cash
+        for t in range(n_steps):
+            OptTrades = self._execute_trades(
+                holding=OptHolding[t],
+                cash=OptCash[t],
+                action=OptAim[t] - OptHolding[t],
+                opt=True,
+            )
+            OptHolding[t + 1] = OptTrades + OptHolding[t] * (1 + nextReturns[t])
+            OptCost[t], OptTradedAmount[t] = self.costs, self.traded_amount
+            OptCash[t + 1] = OptCash[t] + self.traded_amount
+        self.costs, self.traded_amount = 0.0, 0.0
+
+        OptNextHolding = OptHolding[1:]
+        OptNetPNL = np.sum(OptNextHolding * nextReturns, axis=1) - OptCost
+        OptRisk = 0.5 * self.kappa * self.cov.quad_form(OptNextHolding)
+
+        Result = {
+            "{}NextAction".format(tag): OptNextHolding - OptHolding[:-1],
+            "{}NextHolding".format(tag): OptNextHolding,
+            "{}GrossPNL".format(tag): OptNetPNL + OptCost,
+            "{}NetPNL".format(tag): OptNetPNL,
+            "{}Risk".format(tag): OptRisk,
+            "{}Cost".format(tag): OptCost,
+            "{}Reward".format(tag): OptNetPNL - OptRisk,
+            "{}TradedAmount".format(tag): OptTradedAmount,
+            "{}Cash".format(tag): OptCash[1:],
+            "{}Wealth".format(tag): OptNextHolding.sum(axis=1) + OptCash[1:],
+        }
+
+        return Result
+
     def opt_trading_rate_disc_loads(self) -> Tuple[float, np.ndarray]:
 
         # 1 percent annualized discount rate (same rate of Ritter)
@@ -1110,15 +1445,17 @@ class MultiAssetCashMarketEnv(CashMarketEnv):
     ) -> dict:
 
         nextRet = self.returns[iteration+1]
-        currHolding = self.holding_ts[iteration]
-        nextHolding = self.holding_ts[iteration+1] 
+        # copies, since the rows of the histories are overwritten at each episode
+        currHolding = self.holding_ts[iteration].copy()
+        nextHolding = self.holding_ts[iteration+1].copy()
         nextCash = self.cash_ts[iteration+1] 
 
         shares_traded = nextHolding - currHolding
-        NetPNL = np.dot(nextHolding,nextRet) - self.costs
-        Risk = 0.5 * self.kappa * np.dot(np.dot(nextHolding.T,self.cov_matrix),nextHolding)
+        # sums over the last axis, which is the asset one also for stacked rows
+        NetPNL = np.sum(nextHolding * nextRet, axis=-1) - self.costs
+        Risk = 0.5 * self.kappa * self.cov.quad_form(nextHolding)
         Reward = NetPNL - Risk
-        nextWealth = nextHolding.sum() + nextCash
+        nextWealth = nextHolding.sum(axis=-1) + nextCash
 
         Result = {
             "CurrHolding_{}".format(tag): currHolding,
@@ -1189,7 +1526,7 @@ class MultiAssetCashMarketEnv(CashMarketEnv):
         # Portfolio variation
         OptNetPNL = np.dot(OptNextHolding, nextReturn) - self.costs
         # Risk
-        OptRisk = 0.5 * self.kappa * np.dot(np.dot(OptNextHolding.T,self.cov_matrix),OptNextHolding)
+        OptRisk = 0.5 * self.kappa * self.cov.quad_form(OptNextHolding)
         # Compute reward
         OptReward = OptNetPNL - OptRisk
 
@@ -1255,6 +1592,25 @@ class MultiAssetCashMarketEnv(CashMarketEnv):
 @gin.configurable()
 class ShortMultiAssetCashMarketEnv(MultiAssetCashMarketEnv):
 
+    def _execute_trades(
+        self,
+        holding: np.ndarray,
+        cash: float,
+        action: np.ndarray,
+        opt: bool = False,
+    ) -> np.ndarray:
+        # short selling is allowed, so only buys are limited by the available cash
+        action = np.asarray(action, dtype=float)
+
+        buy = action > 0.0
+        sell = action < 0.0
+        cash = np.expand_dims(cash, -1)
+        shares_traded = np.where(buy, np.minimum(cash, action), 0.0)
+        shares_traded = np.where(sell, action, shares_traded)
+
+        self._accumulate_costs(shares_traded, ~(buy | sell), np.zeros_like(sell))
+
+        return shares_traded
 
     def _sell(self, index: int, holding: np.ndarray, action: float):
  
@@ -1292,4 +1648,198 @@ class ShortMultiAssetCashMarketEnv(MultiAssetCashMarketEnv):
             shares_traded = 0.0
             self.costs, self.traded_amount = 0.0, 0.0
 
-            return shares_traded
\ No newline at end of file
+            return shares_traded
+
+class VecMarketEnv:
+    """
+    Batch of independent market environments (e.g. the out-of-sample test seeds)
+    stepped together, so that an agent can select the actions of all of them
+    with a single batched forward pass at each time step. When all the
+    environments are of a class whose step methods are elementwise (MarketEnv
+    and the multi asset cash environments) and share the same parameters, a
+    copy of the first one is given the series of all of them stacked time major
+    as (T, n_envs, ...) and steps the whole batch at once. The other
+    environments (e.g. the single asset cash ones, whose trades branch on the
+    sign of the action) are stepped one at a time.
+    ...
+
+    Attributes
+    ----------
+    envs: list
+        List of instantiated environments, one for each simulated series
+
+    n_envs: int
+        Number of environments in the batch
+
+    cash: int
+        Initial cash, shared by all the environments of the batch
+
+    batched: bool
+        Whether the environments are stepped together as arrays
+
+    batch_env: MarketEnv
+        Copy of the first environment with the stacked series of all of them,
+        rebuilt at each reset since the series can be re-simulated in training
+
+    Methods
+    -------
+    reset() -> np.ndarray
+        Get the initial state representations stacked as (n_envs, state_dim)
+
+    step(currStates: np.ndarray, actions: np.ndarray, iteration: int,
+         tag: str = 'DQN', MV_res: bool = False) -> Tuple[np.ndarray, dict]
+        Make a step of all the environments returning the stacked next states
+        and a dictionary of results stacked as (n_envs, ...)
+
+    store_results(Results: dict, iteration: int)
+        Store the stacked results in a batched buffer of shape (n_envs, T, ...)
+
+    flush_results()
+        Copy the batched buffer to the result buffer of each environment
+
+    store_opt_trajectory(n_steps: int = None, tag: str = 'Opt')
+        Compute and store the benchmark trajectory of each environment
+    """
+
+    def __init__(self, envs: list):
+        self.envs = envs
+        self.n_envs = len(envs)
+        self.cash = envs[0].cash
+        self.batched = self._can_batch()
+        self.batch_env = None
+        self._results, self._n_rows = {}, 0
+
+    def reset(self) -> np.ndarray:
+        currStates = np.stack([env.reset() for env in self.envs])
+        if self.batched:
+            self.batch_env = self._stack_envs()
+        self._results, self._n_rows = {}, 0
+        return currStates
+
+    def step(
+        self,
+        currStates: np.ndarray,
+        actions: np.ndarray,
+        iteration: int,
+        tag: str = "DQN",
+        MV_res: bool = False,
+    ) -> Tuple[np.ndarray, dict]:
+
+        if self.batched:
+            actions = np.asarray(actions)
+            if self.batch_env.multiasset and actions.ndim == 1:
+                # a single residual action for all the assets of an environment
+                actions = actions[:, None]
+            return self._step_env(
+                self.batch_env, currStates, actions, iteration, tag, MV_res
+            )
+
+        nextStates, Results = [], []
+        for env, currState, action in zip(self.envs, currStates, actions):
+            nextState, Result = self._step_env(
+                env, currState, action, iteration, tag, MV_res
+            )
+            nextStates.append(nextState)
+            Results.append(Result)
+
+        return np.stack(nextStates), self._stack_results(Results)
+
+    def store_results(self, Results: dict, iteration: int):
+        for key, value in Results.items():
+            buffer = self._results.get(key)
+            if buffer is None or iteration >= buffer.shape[1]:
+                buffer = self._allocate_results(key, value, iteration)
+            buffer[:, iteration] = value
+        self._n_rows = max(self._n_rows, iteration + 1)
+
+    def flush_results(self):
+        if not self._results:
+            return
+        for j, env in enumerate(self.envs):
+            env.store_trajectory(
+                {key: buffer[j, : self._n_rows] for key, buffer in self._results.items()}
+            )
+
+    def store_opt_trajectory(self, n_steps: int = None, tag: str = "Opt"):
+        for env in self.envs:
+            OptRate, DiscFactorLoads = env.opt_trading_rate_disc_loads()
+            env.store_trajectory(
+                env.opt_trajectory(OptRate, DiscFactorLoads, n_steps=n_steps, tag=tag)
+            )
+
+    # PRIVATE METHODS
+    def _can_batch(self) -> bool:
+        env = self.envs[0]
+        if type(env) not in (
+            MarketEnv,
+            MultiAssetCashMarketEnv,
+            ShortMultiAssetCashMarketEnv,
+        ):
+            return False
+        if any(type(e) is not type(env) for e in self.envs[1:]):
+            return False
+        # plain MarketEnv steps are written for a single asset
+        if bool(env.multiasset) != isinstance(env, MultiAssetCashMarketEnv):
+            return False
+        if env.inp_type not in ("ret", "f", "alpha", "alpha_f"):
+            return False
+        attrs = ["kappa", "sigma", "CostMultiplier", "cm1", "cm2", "cost_type"]
+        attrs += ["reward_type", "inp_type", "f_param", "Startholding", "cash"]
+        attrs += ["multiasset", "corr", "cov_rank", "inputs"]
+        return all(
+            np.array_equal(np.asarray(getattr(e, a)), np.asarray(getattr(env, a)))
+            for e in self.envs[1:]
+            for a in attrs
+        )
+
+    def _stack_envs(self) -> MarketEnv:
+        # shallow copy of the first environment whose series are stacked time
+        # major, so that the step methods indexing them by iteration get the
+        # rows of all the environments, with histories and state buffer to match
+        env = copy.copy(self.envs[0])
+        env.returns = np.stack([np.asarray(e.returns) for e in self.envs], axis=1)
+        if env.factors is not None:
+            env.factors = np.stack([np.asarray(e.factors) for e in self.envs], axis=1)
+        if env.cash:
+            env._allocate_ts(self.envs[0].holding_ts.shape[1:], (self.n_envs,))
+            env.costs, env.traded_amount = 0.0, 0.0
+        if env.multiasset:
+            env._build_state_layout(batch_shape=(self.n_envs,))
+        return env
+
+    @staticmethod
+    def _step_env(
+        env: MarketEnv,
+        currState: np.ndarray,
+        action: Union[float or np.ndarray],
+        iteration: int,
+        tag: str,
+        MV_res: bool,
+    ) -> Tuple[np.ndarray, dict]:
+        if MV_res:
+            out = env.MV_res_step(currState, action, iteration, tag=tag)
+        else:
+            out = env.step(currState, action, iteration, tag=tag)
+        return out[0], out[1]
+
+    def _stack_results(self, Results: list) -> dict:
+        # keys missing for some environments are filled with zeros, as in the
+        # zero initialized result buffers
+        stacked = {}
+        for key in dict.fromkeys(k for Result in Results for k in Result):
+            fill = np.zeros_like(
+                np.asarray(next(R[key] for R in Results if key in R), dtype=float)
+            )
+            stacked[key] = np.array([Result.get(key, fill) for Result in Results])
+        return stacked
+
+    def _allocate_results(self, key: str, value: np.ndarray, iteration: int) -> np.ndarray:
+        # float32 as the result buffers of the environments
+        length = max(len(self.envs[0].returns), 2 * iteration + 1)
+        value = np.asarray(value)
+        buffer = np.zeros((self.n_envs, length) + value.shape[1:], dtype=np.float32)
+        old = self._results.get(key)
+        if old is not None:
+            buffer[:, : old.shape[1]] = old
+        self._results[key] = buffer
+        return buffer
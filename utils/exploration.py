@@ -7,7 +7,7 @@ Created on Tue Apr 28 17:31:42 2020
 
 # There are many different ways of implementing a SumTree in Python.
 # The code below uses a class to define the structure,
-# and uses recursive functions to both traverse and create the SumTree
+# and traverses and updates the SumTree one level at a time for a whole batch
 
 import sys
 import pdb
@@ -17,7 +17,8 @@ import pandas as pd
 
 
 class PER_buffer:
-    # Here we initialize the tree with all nodes = 0, and initialize the data with all values = 0
+    # Here we initialize the tree with all nodes = 0. Experiences are stored in typed
+    # contiguous arrays allocated at the first insert, when their shape is known
     def __init__(
         self,
         PER_e,
@@ -59,18 +60,15 @@ class PER_buffer:
         # Parent nodes = capacity - 1
         # Leaf nodes = capacity
         self.tree = np.zeros(2 * max_experiences - 1)
+        # Depth of the deepest leaves. When the capacity is not a power of 2 the
+        # remaining leaves lie one level above, all nodes above them are parents
+        self.tree_depth = int(np.log2(len(self.tree)))
+        # Same layout holding the max instead of the sum of the children, so that
+        # the max priority among the leaves is always available at the root
+        self.max_tree = np.zeros(2 * max_experiences - 1)
 
         # Contains the experiences (so the size of data is capacity)
-        # self.data = np.zeros(capacity, dtype=object)
-        self.experience = {
-            "s": np.zeros(max_experiences, dtype=object),
-            "a": np.zeros(max_experiences, dtype=object),
-            "r": np.zeros(max_experiences, dtype=object),
-            "s2": np.zeros(max_experiences, dtype=object),
-            "f": np.zeros(max_experiences, dtype=object),
-            "unsc_a": np.zeros(max_experiences, dtype=object),
-            "opt_a": np.zeros(max_experiences, dtype=object),
-        }
+        self.experience = {}
 
     def add(self, exp):
         """Define add function that will add our priority score in the sumtree leaf and 
@@ -83,7 +81,7 @@ class PER_buffer:
         tree_index  0 0  0  We fill the leaves from left to right"""
 
         # Find the max priority
-        max_priority = np.max(self.tree[-self.max_experiences :])
+        max_priority = self.max_tree[0]
 
         # If the max priority = 0 we can't put priority = 0 since this experience will never have a chance to be selected
         # So we use a minimum priority
@@ -97,11 +95,11 @@ class PER_buffer:
         tree_index = self.data_pointer + self.max_experiences - 1
 
         # Update experience
-        # self.data[self.data_pointer] = data
-        # if len(self.experiences['s']) >= self.max_experiences:
-        #     for key in self.experience.keys():
-        #         self.experience[key].pop(0)
         for key, value in exp.items():
+            if key not in self.experience:
+                self.experience[key] = _allocate_experience(
+                    self.max_experiences, value
+                )
             self.experience[key][self.data_pointer] = value
 
         # Update the leaf
@@ -116,35 +114,55 @@ class PER_buffer:
             self.data_pointer = 0
 
     def update(self, tree_index, priority):
-        """Create function to update the leaf priority score and propagate the change through tree"""
-        # Change = new priority score - former priority score
-        change = priority - self.tree[tree_index]
-        self.tree[tree_index] = priority
+        """Update the leaves priority scores and propagate the change through tree.
+        tree_index and priority can be arrays: parents are recomputed level by level
+        from their children, so a batch of leaves is updated without a loop over them"""
+        if np.ndim(tree_index) == 0:
+            # single leaf, as when adding an experience
+            change = priority - self.tree[tree_index]
+            self.tree[tree_index] = priority
+            self.max_tree[tree_index] = priority
+            while tree_index != 0:
+                tree_index = (tree_index - 1) // 2
+                self.tree[tree_index] += change
+                self.max_tree[tree_index] = max(
+                    self.max_tree[2 * tree_index + 1], self.max_tree[2 * tree_index + 2]
+                )
+            return
 
-        # then propagate the change through tree
-        # this method is faster than the recursive loop
-        while tree_index != 0:
+        self.tree[tree_index] = priority
+        self.max_tree[tree_index] = priority
+
+        # first bring the deepest leaves one level up, then all the nodes are at the
+        # same depth and parents can be recomputed level by level without masks
+        deepest = tree_index >= 2 ** self.tree_depth - 1
+        tree_index = np.where(deepest, (tree_index - 1) // 2, tree_index)
+        self._update_parents(tree_index[deepest])
+        for _ in range(self.tree_depth - 1):
             tree_index = (tree_index - 1) // 2
-            self.tree[tree_index] += change
+            self._update_parents(tree_index)
 
     def get_leaf(self, v):
-        parent_index = 0
+        """Downward search of the leaves associated to the array of values v,
+        one tree level at a time for all the values together"""
+        v = np.array(v, dtype=np.float64)
+        parent_index = np.zeros(len(v), dtype=np.int64)
 
-        while True:
+        # downward search, always search for a higher priority node
+        for level in range(self.tree_depth):
             left_child_index = 2 * parent_index + 1
-            right_child_index = left_child_index + 1
-
-            # If we reach bottom, end the search
-            if left_child_index >= len(self.tree):
-                leaf_index = parent_index
-                break
-            else:  # downward search, always search for a higher priority node
-                if v <= self.tree[left_child_index]:
-                    parent_index = left_child_index
-                else:
-                    v -= self.tree[left_child_index]
-                    parent_index = right_child_index
-
+            # in the last level only the nodes which are not leaves go down
+            if level == self.tree_depth - 1:
+                active = left_child_index < len(self.tree)
+                left_child_index = np.where(active, left_child_index, 0)
+            else:
+                active = True
+            left_value = self.tree[left_child_index]
+            go_right = active & (v > left_value)
+            v = v - left_value * go_right
+            parent_index = np.where(active, left_child_index + go_right, parent_index)
+
+        leaf_index = parent_index
         exp_index = leaf_index - self.max_experiences + 1
         self.exp_leaf = {
             key: value[exp_index] for key, value in self.experience.items()
@@ -157,29 +175,20 @@ class PER_buffer:
         return self.tree[0]  # Returns the root node
 
     def sample_batch(self, batch_size):
-        # Create a minibatch array that will contains the minibatch
-        minibatch = {"s": [], "a": [], "r": [], "s2": [], "f": []}
-
-        # one could use also np zeros
-        b_idx = np.empty((batch_size,), dtype=np.int32)
-
         # Calculate the priority segment
         # Here, as explained in the paper, we divide the Range[0, ptotal] into n ranges
         priority_segment = self.total_priority / batch_size  # priority segment
 
-        for i in range(batch_size):
-            # A value is uniformly sample from each range
-            a, b = priority_segment * i, priority_segment * (i + 1)
-            value = self.rng.uniform(a, b)
-
-            # Experience that correspond to each value is retrieved
-            index, priority, data = self.get_leaf(value)
+        # A value is uniformly sample from each range
+        segments = np.arange(batch_size)
+        values = self.rng.uniform(
+            priority_segment * segments, priority_segment * (segments + 1)
+        )
 
-            b_idx[i] = index
-            for key, value in data.items():
-                minibatch[key].append(value)
+        # Experiences that correspond to each value are retrieved
+        b_idx, priorities, minibatch = self.get_leaf(values)
 
-        return b_idx, minibatch
+        return b_idx.astype(np.int32), minibatch
 
     def batch_update(self, tree_idx, abs_errors):
 
@@ -200,7 +209,7 @@ class PER_buffer:
 
         # clipped_errors = np.minimum(abs_errors, self.absolute_error_upper)
         self.PER_a = min(self.final_PER_a, self.PER_a + self.PER_a_growth)
-        if self.sample_type == "TDerror" or "rewards":
+        if self.sample_type == "TDerror" or self.sample_type == "rewards":
             ps = np.power(abs_errors, self.PER_a)
         elif self.sample_type == "diffTDerror":
             ps = np.power(abs_diff_error, self.PER_a)
@@ -208,8 +217,74 @@ class PER_buffer:
             print("Sample type for PER not available")
             sys.exit()
 
-        for ti, p in zip(tree_idx, ps):
-            self.update(ti, p)
+        self.update(tree_idx, ps)
+
+    def _update_parents(self, tree_index):
+        left, right = 2 * tree_index + 1, 2 * tree_index + 2
+        self.tree[tree_index] = self.tree[left] + self.tree[right]
+        self.max_tree[tree_index] = np.maximum(self.max_tree[left], self.max_tree[right])
+
+
+
+class ReplayBuffer:
+    """
+    Fixed-capacity ring buffer for uniform experience replay. Each experience
+    field is backed by a preallocated array, so that inserting costs O(1) and
+    a minibatch is gathered with a single fancy indexing per field.
+    ...
+
+    Attributes
+    ----------
+    max_experiences: int
+        Capacity of the buffer. When full, the oldest experiences are overwritten
+
+    rng: np.random.mtrand.RandomState
+        Random number generator used to sample the minibatch
+
+    experience: dict
+        Dictionary of field name -> array of shape (max_experiences, ...).
+        Floating fields are stored as float32, the others keep the dtype of
+        the inserted value (e.g. int16 action indices)
+
+    Methods
+    -------
+    add(exp: dict)
+        Write an experience in the next slot of the buffer
+
+    sample_batch(batch_size: int) -> dict
+        Sample uniformly a minibatch of experiences
+    """
+
+    def __init__(self, max_experiences: int, rng: np.random.mtrand.RandomState):
+        self.max_experiences = max_experiences
+        self.rng = rng
+        self.data_pointer = 0
+        self.size = 0
+        self.experience = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, exp: dict):
+        for key, value in exp.items():
+            if key not in self.experience:
+                self.experience[key] = _allocate_experience(
+                    self.max_experiences, value
+                )
+            self.experience[key][self.data_pointer] = value
+
+        self.data_pointer = (self.data_pointer + 1) % self.max_experiences
+        self.size = min(self.size + 1, self.max_experiences)
+
+    def sample_batch(self, batch_size: int) -> dict:
+        ids = self.rng.randint(low=0, high=self.size, size=batch_size)
+        return {key: value[ids] for key, value in self.experience.items()}
+
+
+def _allocate_experience(max_experiences: int, value) -> np.ndarray:
+    value = np.asarray(value)
+    dtype = np.float32 if np.issubdtype(value.dtype, np.floating) else value.dtype
+    return np.zeros((max_experiences,) + value.shape, dtype=dtype)
 
 
 # https://github.com/openai/baselines/blob/master/baselines/ddpg/noise.py
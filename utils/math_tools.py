@@ -5,7 +5,9 @@ Created on Tue Feb  9 14:44:16 2021
 @author: alessiobrini
 """
 
+import sys
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
 from typing import Union
 
 
@@ -65,3 +67,242 @@ def boltzmann(x: np.ndarray, T: Union[float or int]) -> np.ndarray:
     y = e_x / e_x.sum(axis=1).reshape(-1, 1)
 
     return y
+
+
+class FactorizedCovariance:
+    """
+    Covariance matrix stored together with a factorization computed once, so
+    that linear systems and quadratic forms cost O(n^2) (or O(nk) in the low
+    rank case) instead of an O(n^3) inversion each time. It is either a dense
+    matrix, factorized by Cholesky (or by eigendecomposition when the matrix
+    is not positive definite), or a low rank plus diagonal matrix
+    diag(diag) + loadings @ loadings.T, which never builds the n x n matrix.
+    ...
+
+    Attributes
+    ----------
+    n: int
+        Size of the covariance matrix
+
+    cov_matrix: Union[np.ndarray or None]
+        Dense covariance matrix. None for the low rank representation
+
+    diag: Union[np.ndarray or None]
+        Diagonal part of the low rank representation
+
+    loadings: Union[np.ndarray or None]
+        Loadings of shape (n, k) of the low rank representation
+
+    Methods
+    -------
+    solve(x: np.ndarray) -> np.ndarray
+        Compute cov^-1 x for each vector stored along the last axis of x
+
+    quad_form(x: np.ndarray) -> Union[float or np.ndarray]
+        Compute x' cov x for each vector stored along the last axis of x
+
+    dense() -> np.ndarray
+        Return the dense covariance matrix, built on request for the low rank
+        representation
+
+    low_rank(cov_matrix: np.ndarray, rank: int) -> FactorizedCovariance
+        Approximate a dense matrix by its leading eigenvectors plus a diagonal
+        matching the original variances
+    """
+
+    def __init__(
+        self,
+        cov_matrix: np.ndarray = None,
+        diag: np.ndarray = None,
+        loadings: np.ndarray = None,
+    ):
+        self.cov_matrix = cov_matrix
+        self.diag = diag
+        self.loadings = loadings
+
+        if cov_matrix is not None:
+            self.n = cov_matrix.shape[0]
+            try:
+                self._chol = cho_factor(cov_matrix)
+            except LinAlgError:
+                # symmetric but not positive definite
+                self._chol = None
+                self._eigvals, self._eigvecs = np.linalg.eigh(cov_matrix)
+        else:
+            self.n = diag.shape[0]
+            # Woodbury identity: only the k x k capacitance matrix is factorized
+            scaled_loadings = loadings / diag[:, np.newaxis]
+            self._capacitance = cho_factor(
+                np.eye(loadings.shape[1]) + np.dot(loadings.T, scaled_loadings)
+            )
+            self._scaled_loadings = scaled_loadings
+
+    def solve(self, x: np.ndarray) -> np.ndarray:
+        x = np.asarray(x, dtype=float)
+        shape = x.shape
+        x = x.reshape(-1, self.n)
+        if self.cov_matrix is None:
+            y = x / self.diag - np.dot(
+                cho_solve(self._capacitance, np.dot(x, self._scaled_loadings).T).T,
+                self._scaled_loadings.T,
+            )
+        elif self._chol is not None:
+            y = cho_solve(self._chol, x.T).T
+        else:
+            y = np.dot(np.dot(x, self._eigvecs) / self._eigvals, self._eigvecs.T)
+        return y.reshape(shape)
+
+    def quad_form(self, x: np.ndarray) -> Union[float or np.ndarray]:
+        x = np.asarray(x, dtype=float)
+        if self.cov_matrix is not None:
+            return np.einsum("...i,ij,...j->...", x, self.cov_matrix, x)
+        return np.sum(self.diag * x ** 2, axis=-1) + np.sum(
+            np.dot(x, self.loadings) ** 2, axis=-1
+        )
+
+    def dense(self) -> np.ndarray:
+        if self.cov_matrix is not None:
+            return self.cov_matrix
+        return np.diag(self.diag) + np.dot(self.loadings, self.loadings.T)
+
+    @classmethod
+    def low_rank(cls, cov_matrix: np.ndarray, rank: int) -> "FactorizedCovariance":
+        eigvals, eigvecs = np.linalg.eigh(cov_matrix)
+        # leading eigenpairs, discarding the non positive ones
+        idx = np.argsort(eigvals)[::-1][:rank]
+        idx = idx[eigvals[idx] > 0.0]
+        loadings = eigvecs[:, idx] * np.sqrt(eigvals[idx])
+        variances = np.diag(cov_matrix)
+        diag = np.maximum(
+            variances - np.sum(loadings ** 2, axis=1),
+            np.finfo(float).eps * variances.max(),
+        )
+        return cls(diag=diag, loadings=loadings)
+
+
+class CorrelationSpec:
+    """
+    Correlation structure of a multi asset universe, parsed and validated once.
+    Besides the legacy constant (float) and pairwise (flat list of the upper
+    triangular entries) specifications, it accepts a dictionary with one of
+    the following structured forms
+
+        {'type': 'block', 'sizes': [n_1, ..., n_g], 'within': float or list, 'between': float}
+        {'type': 'factor', 'loadings': [[b_11, ..., b_1k], ..., [b_n1, ..., b_nk]]}
+        {'type': 'sparse', 'pairs': [[i, j, rho_ij], ...]}
+
+    where the factor form describes the correlation B B' + diag(1 - rowsum(B**2))
+    and the assets not listed in a sparse form are uncorrelated.
+    ...
+
+    Attributes
+    ----------
+    corr: Union[float or list or dict]
+        Correlation specification
+
+    n_assets: int
+        Number of assets in the universe
+
+    kind: str
+        One of 'constant', 'pairwise', 'block', 'factor' or 'sparse'
+
+    state: np.ndarray
+        Compact encoding of the correlation used as input of the agents. Its size
+        is O(n_assets) for the structured forms instead of n_assets(n_assets-1)/2
+
+    Methods
+    -------
+    covariance(sigma: float, cov_rank: int = None) -> FactorizedCovariance
+        Build the covariance of the assets with constant volatility sigma
+    """
+
+    def __init__(self, corr: Union[float or list or dict], n_assets: int):
+        self.corr = corr
+        self.n_assets = n_assets
+
+        if isinstance(corr, float):
+            self.kind = "constant"
+            values = np.array([corr])
+        elif isinstance(corr, list):
+            self.kind = "pairwise"
+            values = np.array(corr, dtype=float)
+            if len(values) != n_assets * (n_assets - 1) // 2:
+                print("Pairwise correlations must have n_assets(n_assets-1)/2 entries")
+                sys.exit()
+        elif isinstance(corr, dict) and corr.get("type") == "block":
+            self.kind = "block"
+            self.sizes = np.array(corr["sizes"], dtype=int)
+            self.within = np.broadcast_to(
+                np.array(corr["within"], dtype=float), self.sizes.shape
+            )
+            self.between = float(corr["between"])
+            values = np.append(self.within, self.between)
+            if self.sizes.sum() != n_assets:
+                print("Block sizes of the correlation do not sum to the number of assets")
+                sys.exit()
+        elif isinstance(corr, dict) and corr.get("type") == "factor":
+            self.kind = "factor"
+            self.loadings = np.array(corr["loadings"], dtype=float).reshape(n_assets, -1)
+            values = self.loadings.ravel()
+            if np.any(np.sum(self.loadings ** 2, axis=1) >= 1.0):
+                print("Factor loadings of the correlation must have squared row sums below 1")
+                sys.exit()
+        elif isinstance(corr, dict) and corr.get("type") == "sparse":
+            self.kind = "sparse"
+            pairs = np.array(corr["pairs"], dtype=float).reshape(-1, 3)
+            self.rows, self.cols = pairs[:, 0].astype(int), pairs[:, 1].astype(int)
+            values = pairs[:, 2]
+            if (
+                np.any(self.rows == self.cols)
+                or np.any(np.minimum(self.rows, self.cols) < 0)
+                or np.any(np.maximum(self.rows, self.cols) >= n_assets)
+            ):
+                print("Sparse correlation pairs must refer to two different assets")
+                sys.exit()
+        else:
+            print("Correlation specification not supported")
+            sys.exit()
+
+        if np.any(np.abs(values) > 1.0) and self.kind != "factor":
+            print("Correlations must lie in [-1, 1]")
+            sys.exit()
+        self.state = values
+
+    def covariance(self, sigma: float, cov_rank: int = None) -> FactorizedCovariance:
+        var = sigma ** 2
+        n = self.n_assets
+
+        if self.kind == "factor":
+            # exactly a low rank plus diagonal matrix
+            return FactorizedCovariance(
+                diag=var * (1 - np.sum(self.loadings ** 2, axis=1)),
+                loadings=sigma * self.loadings,
+            )
+        elif self.kind == "constant" and cov_rank and self.corr >= 0.0:
+            # constant correlation is exactly a rank one plus diagonal matrix
+            return FactorizedCovariance(
+                diag=np.full(n, (1 - self.corr) * var),
+                loadings=np.full((n, 1), np.sqrt(self.corr) * sigma),
+            )
+
+        if self.kind == "constant":
+            corr_matrix = np.full((n, n), self.corr)
+        elif self.kind == "pairwise":
+            corr_matrix = np.zeros((n, n))
+            corr_matrix[np.triu_indices(n, k=1)] = self.state
+            corr_matrix = corr_matrix + corr_matrix.T
+        elif self.kind == "block":
+            groups = np.repeat(np.arange(len(self.sizes)), self.sizes)
+            corr_matrix = np.where(
+                groups[:, np.newaxis] == groups, self.within[groups], self.between
+            )
+        elif self.kind == "sparse":
+            corr_matrix = np.zeros((n, n))
+            corr_matrix[self.rows, self.cols] = self.state
+            corr_matrix[self.cols, self.rows] = self.state
+        np.fill_diagonal(corr_matrix, 1.0)
+
+        # symmetric by construction
+        if cov_rank:
+            return FactorizedCovariance.low_rank(corr_matrix * var, cov_rank)
+        return FactorizedCovariance(corr_matrix * var)
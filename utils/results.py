@@ -0,0 +1,283 @@
+from typing import Union
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+
+class ResultStore:
+    """
+    Preallocated columnar store for the quantities produced by the environments
+    at each step. Every result key is backed by a contiguous float32 array of
+    fixed length, so that storing a step costs O(1) and a DataFrame is built only
+    when it is explicitly requested.
+    ...
+
+    Attributes
+    ----------
+    length: int
+        Number of rows preallocated for each column
+
+    columns: dict
+        Dictionary of name -> array. Scalar results are stored as 1-D arrays of
+        shape (length,), vector results (e.g. multi-asset holdings) as 2-D blocks
+        of shape (length, n)
+
+    Methods
+    -------
+    store(Result: dict, iteration: int)
+        Write the dictionary of current results at the row given by iteration
+
+    store_series(Result: dict, start: int = 0)
+        Write a dictionary of whole result series (e.g. a benchmark trajectory)
+        starting from the row given by start
+
+    to_frame() -> pd.DataFrame
+        Convert the stored arrays into a DataFrame with one column per scalar
+        quantity and the vector quantities expanded as key_0, key_1, ...
+    """
+
+    def __init__(
+        self,
+        length: int,
+        data: Union[np.ndarray or None] = None,
+        colnames: Union[list or None] = None,
+        dtype: np.dtype = np.float32,
+    ):
+        self.length = length
+        self.n_rows = length
+        self.dtype = dtype
+        self.columns = {}
+        self._frame = None
+
+        # static columns (e.g. returns and factors) known at construction time
+        if data is not None:
+            data = np.asarray(data, dtype=dtype).reshape(length, -1)
+            for i, name in enumerate(colnames):
+                self.columns[name] = data[:, i].copy()
+
+    def store(self, Result: dict, iteration: int):
+        if iteration >= self.length:
+            self._grow(iteration + 1)
+        self.n_rows = max(self.n_rows, iteration + 1)
+
+        for key, value in Result.items():
+            col = self.columns.get(key)
+            if col is None:
+                col = self._allocate(key, value)
+            col[iteration] = value
+
+        self._frame = None
+
+    def store_series(self, Result: dict, start: int = 0):
+        n_steps = len(next(iter(Result.values())))
+        end = start + n_steps
+        if end > self.length:
+            self._grow(end)
+        self.n_rows = max(self.n_rows, end)
+
+        for key, value in Result.items():
+            value = np.asarray(value)
+            col = self.columns.get(key)
+            if col is None:
+                col = self._allocate(key, value[0] if value.ndim > 1 else 0.0)
+            col[start:end] = value
+
+        self._frame = None
+
+    def to_frame(self) -> pd.DataFrame:
+        if self._frame is None:
+            data = {}
+            for key, col in self.columns.items():
+                col = col[: self.n_rows]
+                if col.ndim == 1:
+                    data[key] = col
+                else:
+                    for i in range(col.shape[1]):
+                        data[key + "_{}".format(i)] = col[:, i]
+            self._frame = pd.DataFrame(data, copy=True)
+        return self._frame
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        if key in self.columns:
+            return self.columns[key][: self.n_rows]
+        # single component of a vector quantity, as named in the DataFrame
+        name, _, idx = key.rpartition("_")
+        if name in self.columns and idx.isdigit():
+            return self.columns[name][: self.n_rows, int(idx)]
+        raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    # PRIVATE METHODS
+    def _allocate(self, key: str, value) -> np.ndarray:
+        if isinstance(value, (list, np.ndarray)):
+            col = np.zeros((self.length, len(value)), dtype=self.dtype)
+        else:
+            col = np.zeros(self.length, dtype=self.dtype)
+        self.columns[key] = col
+        return col
+
+    def _grow(self, min_length: int):
+        new_length = max(min_length, 2 * self.length)
+        for key, col in self.columns.items():
+            new_col = np.zeros((new_length,) + col.shape[1:], dtype=self.dtype)
+            new_col[: self.length] = col
+            self.columns[key] = new_col
+        self.length = new_length
+
+
+# column of each out-of-sample metric, name of the metric and agent it refers
+# to (None for the tested agent, GP for the benchmark)
+OOS_METRICS = [
+    ("pnl", "NetPnl", None),
+    ("rew", "Reward", None),
+    ("sr", "SR", None),
+    ("pnl_std", "PnLstd", None),
+    ("abs_pnl_rl", "AbsNetPnl", None),
+    ("abs_pnl_gp", "AbsNetPnl", "GP"),
+    ("abs_rew_rl", "AbsRew", None),
+    ("abs_rew_gp", "AbsRew", "GP"),
+    ("abs_sr_rl", "AbsSR", None),
+    ("abs_sr_gp", "AbsSR", "GP"),
+    ("abs_hold_rl", "AbsHold", None),
+    ("abs_hold_gp", "AbsHold", "GP"),
+    ("pdist", "Pdist", "GP"),
+    ("abs_wealth_rl", "AbsWealth", None),
+    ("abs_wealth_gp", "AbsWealth", "GP"),
+]
+
+OOS_METRICS_FILE = "Metrics_OOS_{}_{}.parquet"
+
+
+def oos_metrics_table(metrics: np.ndarray, checkpoints: list, tag: str) -> pd.DataFrame:
+    """
+    Convert the checkpoint by metric matrix of an out-of-sample test into the
+    long format table stored for each run, with one row per metric, agent and
+    checkpoint. Rows are sorted by metric, so that the row group statistics of
+    the metric column let readers skip what they do not need.
+
+    Parameters
+    ----------
+    metrics: np.ndarray
+        Matrix of shape (n_checkpoints, len(OOS_METRICS))
+
+    checkpoints: list
+        Checkpoints of the rows of the matrix
+
+    tag: str
+        Name of the tested agent
+
+    Returns
+    -------
+    table: pd.DataFrame
+        Table with columns metric, agent, checkpoint and value. Metrics that
+        are not available are dropped
+    """
+    n_checkpoints = len(checkpoints)
+    table = pd.DataFrame(
+        {
+            "metric": np.repeat([m for _, m, _ in OOS_METRICS], n_checkpoints),
+            "agent": np.repeat([a or tag for _, _, a in OOS_METRICS], n_checkpoints),
+            "checkpoint": np.tile(
+                np.asarray(checkpoints, dtype=np.int64), len(OOS_METRICS)
+            ),
+            "value": np.asarray(metrics, dtype=np.float64).T.ravel(),
+        }
+    )
+    table = table.dropna(subset=["value"])
+    return table.sort_values(["metric", "agent", "checkpoint"], ignore_index=True)
+
+
+def read_oos_metrics(run_dirs: list, N_test: str) -> pd.DataFrame:
+    """
+    Read the out-of-sample metrics of many runs into a single long format
+    table. Each run folder is opened once, whatever the number of metrics that
+    are plotted afterwards. Runs saved before the metrics table was introduced
+    are read from their one-row series files.
+
+    Parameters
+    ----------
+    run_dirs: list
+        Folders of the runs
+
+    N_test: str
+        Length of the test series as formatted in the file names
+
+    Returns
+    -------
+    table: pd.DataFrame
+        Table with columns run (position of the run in run_dirs), metric, agent,
+        checkpoint and value
+    """
+    tables = []
+    for i, run_dir in enumerate(run_dirs):
+        paths = glob.glob(os.path.join(run_dir, OOS_METRICS_FILE.format(N_test, "*")))
+        if paths:
+            table = pd.read_parquet(paths[0])
+        else:
+            table = _read_oos_series(run_dir, N_test)
+        table.insert(0, "run", i)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+def pivot_oos_metric(table: pd.DataFrame, metric: str, agent: str) -> pd.DataFrame:
+    """
+    Select a metric of an agent from a table returned by read_oos_metrics
+
+    Returns
+    -------
+    series: pd.DataFrame
+        One row per run, in the order of the table, and one column per checkpoint
+    """
+    runs = np.unique(table["run"])
+    table = table[(table["metric"] == metric) & (table["agent"] == agent)]
+    series = table.pivot(index="run", columns="checkpoint", values="value")
+    series = series.reindex(index=runs, columns=sorted(series.columns))
+    series.columns = [str(c) for c in series.columns]
+    series.index = range(len(runs))
+    return series
+
+
+def read_oos_metric(run_dirs: list, filename: str) -> pd.DataFrame:
+    """
+    Read one metric for many runs, given the name of its one-row series file
+    (e.g. NetPnl_OOS_5k_DQN.parquet.gzip)
+    """
+    metric, N_test, agent = parse_oos_filename(filename)
+    return pivot_oos_metric(read_oos_metrics(run_dirs, N_test), metric, agent)
+
+
+def parse_oos_filename(filename: str) -> tuple:
+    # e.g. AbsNetPnl_OOS_5k_GP.parquet.gzip -> (AbsNetPnl, 5k, GP)
+    metric, rest = os.path.basename(filename).split(".")[0].split("_OOS_")
+    N_test, agent = rest.rsplit("_", 1)
+    return metric, N_test, agent
+
+
+def _read_oos_series(run_dir: str, N_test: str) -> pd.DataFrame:
+    tables = []
+    pattern = os.path.join(run_dir, "*_OOS_{}_*.parquet.gzip".format(N_test))
+    for path in glob.glob(pattern):
+        metric, _, agent = parse_oos_filename(path)
+        if metric == "Metrics":
+            continue
+        series = pd.read_parquet(path).iloc[0]
+        tables.append(
+            pd.DataFrame(
+                {
+                    "metric": metric,
+                    "agent": agent,
+                    "checkpoint": series.index.astype(np.int64),
+                    "value": series.values.astype(np.float64),
+                }
+            )
+        )
+    return pd.concat(tables, ignore_index=True)
+
@@ -5,8 +5,14 @@ Created on Thu Feb 27 11:32:29 2020
 @author: aless
 """
 from typing import Tuple, Union
+import os
+import json
+import shutil
+import hashlib
+import tempfile
 import numpy as np
 from tqdm import tqdm
+from scipy.signal import lfilter
 import pdb, sys
 from statsmodels.tsa.stattools import adfuller
 import matplotlib.pyplot as plt
@@ -110,6 +116,102 @@ class DataHandler:
         self.factors = df.iloc[:, 1:].values
 
 
+class SeriesCache:
+    """
+    Content-addressed on-disk cache of simulated series. Each entry is a folder
+    named after the hash of the configuration that generated the series and
+    contains one .npy file per field, stacked over the simulated paths. Entries
+    are opened as read-only memory maps, so that every checkpoint and every
+    parallel process reading the same entry share the pages of the OS cache
+    instead of simulating the series again.
+    ...
+
+    Attributes
+    ----------
+    cache_dir: str
+        Directory containing the cache entries
+
+    Methods
+    -------
+    key(config: dict) -> str
+        Hash of the configuration used to generate the series
+
+    load(key: str) -> Union[dict or None]
+        Memory-map the fields of an entry, None if the entry does not exist
+
+    store(key: str, series: dict) -> dict
+        Write the fields of an entry and return them memory-mapped
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(config: dict) -> str:
+        dump = json.dumps(config, sort_keys=True, default=repr)
+        return hashlib.sha256(dump.encode()).hexdigest()[:24]
+
+    def load(self, key: str) -> Union[dict or None]:
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(path):
+            return None
+        return {
+            name[: -len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+            for name in os.listdir(path)
+        }
+
+    def store(self, key: str, series: dict) -> dict:
+        # write in a temporary folder and rename it, so that concurrent writers
+        # of the same entry never expose a partially written one
+        tmp = tempfile.mkdtemp(dir=self.cache_dir)
+        for name, value in series.items():
+            np.save(os.path.join(tmp, name + ".npy"), np.asarray(value))
+        try:
+            os.rename(tmp, os.path.join(self.cache_dir, key))
+        except OSError:
+            # the entry has already been written by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        return self.load(key)
+
+
+def simulate_ou_factors(
+    noise: np.ndarray, lambdas: Union[list or np.ndarray], dt: int = 1
+) -> np.ndarray:
+    """
+    Simulates discretized OU factors starting from zero,
+    f_t = (1 - lambda * dt) * f_{t-1} + noise_t,
+    as a linear filter over the time axis instead of a loop over time steps.
+
+    Parameters
+    ----------
+    noise : np.ndarray
+        Scaled noise of shape (..., T, n_factors) or (..., T, 1) when the same
+        noise drives all the factors. Leading dimensions are independent paths
+
+    lambdas: Union[list or np.ndarray]
+        Speeds of mean reversion of the factors
+
+    dt: int = 1
+        Time step of the discretization
+
+    Returns
+    -------
+    factors: np.ndarray
+        Simulated factors of shape (..., T, n_factors)
+    """
+    lambdas = np.atleast_1d(lambdas)
+    noise = np.broadcast_to(noise, noise.shape[:-1] + (len(lambdas),))
+
+    factors = np.empty(noise.shape)
+    for i, lam in enumerate(lambdas):
+        factors[..., i] = lfilter(
+            [1.0], [1.0, -(1 - lam * dt)], noise[..., i], axis=-1
+        )
+
+    return factors
+
+
 @gin.configurable()
 def return_sampler_GP(
     N_train: int,
@@ -125,6 +227,7 @@ def return_sampler_GP(
     vol: str = "omosk",
     dt: int = 1,
     disable_tqdm: bool = False,
+    n_paths: int = None,
 ) -> Tuple[
     Union[list or np.ndarray], Union[list or np.ndarray], Union[list or np.ndarray]
 ]:
@@ -166,12 +269,18 @@ def return_sampler_GP(
 
     vol: str = 'omosk'
         Choose between 'omosk' and 'eterosk' for the kind of volatility
+
+    n_paths: int = None
+        Number of independent paths to simulate at once. If None, a single path
+        is simulated, otherwise outputs have an additional leading dimension
     Returns
     -------
     realret: Union[list or np.ndarray]
-        Simulated series of returns
+        Simulated series of returns of shape (N_train + offset,) or
+        (n_paths, N_train + offset)
     factors: Union[list or np.ndarray]
-        Simulated series of factors
+        Simulated series of factors of shape (N_train + offset, n_factors) or
+        (n_paths, N_train + offset, n_factors)
     f_speed: Union[list or np.ndarray]
         Speed of mean reversion computed form HalfLife argument
     """
@@ -184,47 +293,37 @@ def return_sampler_GP(
     # Generate stochastic factor component and compute speed of mean reversion
     # simulate the single factor according to OU process
     # select proper speed of mean reversion and initialization point
-    # it is faster to increase the size of a python list than a numpy array
-    # therefore we convert later the list
     # https://www.jmp.com/en_us/statistics-knowledge-portal/t-test/t-distribution.html#:~:text=The%20shape%20of%20the%20t,%E2%80%9D%20than%20the%20z%2Ddistribution.
 
     lambdas = np.around(np.log(2) / HalfLife, 4)
 
-    f0 = np.zeros(shape=(len(lambdas),))
+    # leading batch dimension for independent paths, if requested
+    size = (N_train + offset,) if n_paths is None else (n_paths, N_train + offset)
 
     if vol == "omosk":
         if t_stud:
             if uncorrelated:
-                eps = rng.standard_t(degrees, (N_train + offset, len(HalfLife)))
+                eps = rng.standard_t(degrees, size + (len(HalfLife),))
             else:
-                eps = rng.standard_t(degrees, (N_train + offset))
+                eps = rng.standard_t(degrees, size)[..., np.newaxis]
         else:
             if uncorrelated:
-                eps = rng.randn(N_train + offset, len(HalfLife))
+                eps = rng.randn(*size, len(HalfLife))
             else:
-                eps = rng.randn(N_train + offset)
-
-        f = []
-
-        # possibility of triple noise
-        for i in tqdm(
-            iterable=range(N_train + offset),
-            desc="Simulating Factors",
-            disable=disable_tqdm,
-        ):
-            # multiply makes the hadamard (componentwise) product
-            # if we want to add different volatility for different factors we could
-            # add multiply also the the second part of the equation
-            f1 = np.multiply((1 - lambdas*dt), f0) + np.multiply(np.array(sigmaf)*np.sqrt(dt), eps[i])
-            f.append(f1)
-            f0 = f1
+                eps = rng.randn(*size)[..., np.newaxis]
+
+        # if we want to add different volatility for different factors we could
+        # add multiply also the the second part of the equation
+        factors = simulate_ou_factors(
+            np.multiply(np.array(sigmaf) * np.sqrt(dt), eps), lambdas, dt
+        )
 
     elif vol == "heterosk":
         volmodel = GARCH(p=1, q=1)
         # these factors, if multiple, are uncorrelated by default because the noise is constructed one by one
-        if len(sigmaf) > 1:
-
-            eps = []
+        eps = []
+        for _ in range(1 if n_paths is None else n_paths):
+            path_eps = []
             for i in range(len(sigmaf)):
                 om = sigmaf[i] ** 2  # same vol as original GP experiments
                 alph = 0.05
@@ -232,43 +331,22 @@ def return_sampler_GP(
                 garch_p = np.array([om, alph, b])
 
                 e = volmodel.simulate(garch_p, N_train + offset, rng.randn)[0]
-                eps.append(e.reshape(-1, 1))
-
-            eps = np.concatenate(eps, axis=1)
-        else:
-
-            om = sigmaf[0] ** 2  # same vol as original GP experiments
-            alph = 0.05
-            b = 1 - alph - om
-            garch_p = np.array([om, alph, b])
+                path_eps.append(e.reshape(-1, 1))
+            eps.append(np.concatenate(path_eps, axis=1))
+        eps = eps[0] if n_paths is None else np.stack(eps)
 
-            eps = volmodel.simulate(garch_p, N_train + offset, rng.randn)[0]
-
-        f = []
-        # possibility of triple noise
-        for i in tqdm(
-            iterable=range(N_train + offset),
-            desc="Simulating Factors",
-            disable=disable_tqdm,
-        ):
-            # multiply makes the hadamard (componentwise) product
-            # if we want to add different volatility for different factors we could
-            # add multiply also the the second part of the equation
-            f1 = np.multiply((1 - lambdas*dt), f0) + eps[i]*np.sqrt(dt)
-            f.append(f1)
-            f0 = f1
+        factors = simulate_ou_factors(eps * np.sqrt(dt), lambdas, dt)
     else:
         print("Choose proper volatility setting")
         sys.exit()
 
-    factors = np.vstack(f)
     if vol == "omosk":
         if t_stud:
-            u = rng.standard_t(degrees, N_train + offset)
+            u = rng.standard_t(degrees, size)
         else:
-            u = rng.randn(N_train + offset)
+            u = rng.randn(*size)
 
-        realret = np.sum(f_param * factors, axis=1) + sigma * u
+        realret = np.sum(f_param * factors, axis=-1) + sigma * u
 
     elif vol == "heterosk":
         volmodel = GARCH(p=1, q=1)
@@ -277,9 +355,17 @@ def return_sampler_GP(
         b = 1 - alph - om
         garch_p = np.array([om, alph, b])
 
-        u = volmodel.simulate(garch_p, N_train + offset, rng.randn)[0]
+        if n_paths is None:
+            u = volmodel.simulate(garch_p, N_train + offset, rng.randn)[0]
+        else:
+            u = np.stack(
+                [
+                    volmodel.simulate(garch_p, N_train + offset, rng.randn)[0]
+                    for _ in range(n_paths)
+                ]
+            )
 
-        realret = np.sum(f_param * factors, axis=1) + sigma * u
+        realret = np.sum(f_param * factors, axis=-1) + sigma * u
     else:
         print("Choose proper volatility setting")
         sys.exit()
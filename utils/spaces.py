@@ -1,4 +1,5 @@
 from gin.config import configurable
+from typing import Union
 from gym.spaces.space import Space
 import numpy as np
 import gin
@@ -22,6 +23,12 @@ class ActionSpace(Space):
     contains(x: float or int)-> bool
         check if an integer action is contained in the discretized space
         and return a boolean
+
+    get_value(index: Union[int or np.ndarray]) -> Union[float or np.ndarray]
+        map the index (or array of indices) of actions to their values
+
+    get_index(x: float or int) -> int
+        map the value of an action to its index in the discretized space
     """
 
     def __init__(
@@ -44,6 +51,12 @@ class ActionSpace(Space):
     def contains(self, x: int) -> bool:
         return x in self.values
 
+    def get_value(self, index: Union[int or np.ndarray]) -> Union[float or np.ndarray]:
+        return self.values[index]
+
+    def get_index(self, x: Union[float or int]) -> int:
+        return int(np.flatnonzero(self.values == x)[0])
+
     def get_n_actions(self, policy_type: str):
         # TODO note that this implementation is valid only for a single action.
         # If we want to do more than one action we should change it
@@ -70,6 +83,12 @@ class ResActionSpace(Space):
     contains(x: float or int)-> bool
         check if an integer action is contained in the discretized space
         and return a boolean
+
+    get_value(index: Union[int or np.ndarray]) -> Union[float or np.ndarray]
+        map the index (or array of indices) of actions to their values
+
+    get_index(x: float or int) -> int
+        map the value of an action to its index in the discretized space
     """
 
     def __init__(
@@ -90,6 +109,12 @@ class ResActionSpace(Space):
     def contains(self, x: int) -> bool:
         return x in self.values
 
+    def get_value(self, index: Union[int or np.ndarray]) -> Union[float or np.ndarray]:
+        return self.values[index]
+
+    def get_index(self, x: Union[float or int]) -> int:
+        return int(np.flatnonzero(self.values == x)[0])
+
     def get_n_actions(self, policy_type: str):
         # TODO note that this implementation is valid only for a single action.
         # If we want to do more than one action we should change it
@@ -97,3 +122,34 @@ class ResActionSpace(Space):
             return self.values.ndim
         elif policy_type == "discrete":
             return self.values.size
+
+
+class DiscreteGrid:
+    """
+    Sorted grid of points used to discretize a continuous quantity (e.g. returns
+    or holdings for the tabular Q-learning). Nearest point queries are answered
+    by binary search in O(log n), both for a single value and for a whole array.
+    ...
+
+    Attributes
+    ----------
+    values : np.ndarray
+        numpy array containing the sorted points of the grid
+
+    Methods
+    -------
+    nearest(x: Union[float or np.ndarray]) -> Union[float or np.ndarray]
+        map each value to the nearest point of the grid. Ties are broken
+        towards the lower point
+    """
+
+    def __init__(self, values: Union[list or np.ndarray]):
+        self.values = np.sort(np.asarray(values).ravel())
+
+    def nearest(self, x: Union[float or np.ndarray]) -> Union[float or np.ndarray]:
+        x = np.asarray(x, dtype=float)
+        if self.values.size == 1:
+            return np.full(x.shape, self.values[0])[()]
+        idx = np.clip(np.searchsorted(self.values, x), 1, self.values.size - 1)
+        lower, upper = self.values[idx - 1], self.values[idx]
+        return np.where(x - lower <= upper - x, lower, upper)[()]
@@ -9,11 +9,13 @@ from utils.spaces import (
     ActionSpace,
     ResActionSpace,
 )
-from utils.env import MarketEnv
+from utils.env import MarketEnv, VecMarketEnv
 from utils.tools import CalculateLaggedSharpeRatio, RunModels
 from utils.common import format_tousands
 import gin
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from typing import Union, Optional
@@ -23,7 +25,8 @@ from utils.tools import get_bet_size
 import torch
 import torch.nn as nn
 from utils.math_tools import unscale_action, unscale_asymmetric_action
-from utils.simulation import DataHandler
+from utils.simulation import DataHandler, SeriesCache
+from utils.results import OOS_METRICS, OOS_METRICS_FILE, oos_metrics_table
 
 
 @gin.configurable()
@@ -38,6 +41,9 @@ class Out_sample_vs_gp:
         experiment_type: str,
         env_cls: object,
         MV_res: bool,
+        cache_dir: str = None,
+        n_workers: int = 0,
+        worker_threads: int = 1,
     ):
 
         variables = []
@@ -55,452 +61,442 @@ class Out_sample_vs_gp:
         self.experiment_type = experiment_type
         self.env_cls = env_cls
         self.MV_res = MV_res
+        self.cache_dir = cache_dir
+        # simulated test series reused across the checkpoints of the run
+        self._series_key, self._series = None, None
+        # process pool of the asynchronous tests and their pending results
+        self.n_workers = n_workers
+        self.worker_threads = worker_threads
+        self._pool, self._pending = None, []
+        self.cash = None
 
     def run_test(self, test_agent: object, it: int = 0, return_output: bool = False):
 
         rng = np.random.RandomState(self.rnd_state)
         seeds = rng.choice(1000, self.n_seeds, replace=False)
-        self.rng_test = np.random.RandomState(self.rnd_state)
 
-        avg_pnls = []
-        avg_rews = []
-        avg_srs = []
-        abs_pnl_rl = []
-        abs_pnl_gp = []
-        abs_rew_rl = []
-        abs_rew_gp = []
-        abs_sr_rl = []
-        abs_sr_gp = []
-        abs_hold_rl = []
-        abs_hold_gp = []
-        avg_pnlstd = []
-        avg_pdist = []
-        abs_wealth_rl = []
-        abs_wealth_gp = []
-
-        for s in seeds:
-            if 'alpha' in gin.query_parameter('%INP_TYPE'):
-                data_handler = DataHandler(N_train=self.N_test, rng=self.rng_test)
-            else:
-                data_handler = DataHandler(N_train=self.N_test, rng=self.rng_test)
+        # when the output dataframe is requested only the first series is used
+        n_seeds = 1 if return_output else len(seeds)
 
-            if self.experiment_type == "GP":
-                data_handler.generate_returns()
-            else:
-                data_handler.generate_returns()
-                # TODO check if these method really fit and change the parameters in the gin file
-                data_handler.estimate_parameters()
-            
-            self.test_env = self.env_cls(
+        # the test series are simulated in advance and stepped together, so
+        # that the agent runs a single batched forward pass at each time step
+        envs = [
+            self.env_cls(
                 N_train=self.N_test,
-                f_speed=data_handler.f_speed,
-                returns=data_handler.returns,
-                factors=data_handler.factors,
+                f_speed=series["f_speed"],
+                returns=series["returns"],
+                factors=series["factors"],
             )
+            for series in self._load_test_series(n_seeds)
+        ]
+        datatype = gin.get_bindings(DataHandler).get("datatype")
+        self.test_env = VecMarketEnv(envs)
+        self.cash = self.test_env.cash
+
+        CurrStates = self.test_env.reset()
+
+        for i in tqdm(iterable=range(self.N_test + 1), desc="Testing DQNetwork"):
+
+            if self.tag == "DQN":
+
+                side_only = test_agent.action_space.side_only
+
+                qvalues = test_agent.model.fast_call(CurrStates)
+                actions = test_agent.action_space.get_value(np.argmax(qvalues, axis=1))
+                if side_only:
+                    actions = np.array(
+                        [
+                            get_bet_size(
+                                qvalues[k : k + 1],
+                                action,
+                                action_limit=test_agent.action_space.action_range[0],
+                                zero_action=test_agent.action_space.zero_action,
+                                rng=self.rng,
+                            )
+                            for k, action in enumerate(actions)
+                        ]
+                    )
 
-            CurrState = self.test_env.reset()
-
-            
-            CurrOptState = self.test_env.opt_reset()
-            OptRate, DiscFactorLoads = self.test_env.opt_trading_rate_disc_loads()
-
-            for i in tqdm(iterable=range(self.N_test + 1), desc="Testing DQNetwork"):
+                NextStates, Results = self.test_env.step(
+                    CurrStates, actions, i, tag="DQN", MV_res=self.MV_res
+                )
+                self.test_env.store_results(Results, i)
 
-                if self.tag == "DQN":
+            elif self.tag == "PPO":
+                side_only = test_agent.action_space.side_only
+                test_agent.model.eval()
+                CurrStates = CurrStates.astype(np.float32)
+                states = torch.from_numpy(CurrStates).to(test_agent.device)
 
-                    side_only = test_agent.action_space.side_only
+                # PPO actions
+                with torch.no_grad():
+                    dist, qvalues = test_agent.model(states)
 
-                    action, qvalues = test_agent.greedy_action(
-                        CurrState, side_only=side_only
-                    )
-                    if side_only:
-                        action = get_bet_size(
-                            qvalues,
-                            action,
-                            action_limit=test_agent.action_space.action_range[0],
-                            zero_action=test_agent.action_space.zero_action,
-                            rng=self.rng,
-                        )
+                if test_agent.policy_type == "continuous":
+                    # action = dist.sample()
+                    actions = nn.Tanh()(dist.mean).cpu().numpy()[:, 0]
 
                     if self.MV_res:
-                        NextState, Result, _ = self.test_env.MV_res_step(
-                            CurrState, action, i
+                        actions = unscale_asymmetric_action(
+                            test_agent.action_space.action_range[0],test_agent.action_space.action_range[1], actions
                         )
                     else:
-                        NextState, Result, NextFactors = self.test_env.step(
-                            CurrState, action, i,
+                        actions = unscale_action(
+                            test_agent.action_space.values[-1], actions
                         )
-                    self.test_env.store_results(Result, i)
-
-                elif self.tag == "PPO":
-                    side_only = test_agent.action_space.side_only
-                    test_agent.model.eval()
-                    CurrState = torch.from_numpy(CurrState).float()
-                    CurrState = CurrState.to(test_agent.device)
-
-                    # PPO actions
-                    with torch.no_grad():
-                        dist, qvalues = test_agent.model(CurrState.unsqueeze(0))
-
-                    if test_agent.policy_type == "continuous":
-                        # action = dist.sample()
-                        action = dist.mean
-                        action = nn.Tanh()(action).cpu().numpy().ravel()[0]
-
-                        if self.MV_res:
-                            action = unscale_asymmetric_action(
-                                test_agent.action_space.action_range[0],test_agent.action_space.action_range[1], action
-                            )
-                        else:
-                            action = unscale_action(
-                                test_agent.action_space.values[-1], action
-                            )
-
-                    elif test_agent.policy_type == "discrete":
-                        # action = test_agent.action_space.values[dist.sample()]
-                        action = test_agent.action_space.values[torch.max(dist.logits, axis=1)[1]]
-
-                    if side_only:
-                        action = get_bet_size(
-                            qvalues,
-                            action,
-                            action_limit=test_agent.action_space.action_range[0],
-                            zero_action=test_agent.action_space.zero_action,
-                            rng=self.rng,
-                        )
-                    if self.MV_res:
-                        NextState, Result = self.test_env.MV_res_step(
-                            CurrState.cpu(), action, i, tag="PPO"
-                        )
-                    else:
-                        NextState, Result, _ = self.test_env.step(
-                            CurrState.cpu(), action, i, tag="PPO"
-                        )
-                    
-                    self.test_env.store_results(Result, i)
-
-                CurrState = NextState
-
-                # benchmark agent
-
-                NextOptState, OptResult = self.test_env.opt_step(
-                    CurrOptState, OptRate, DiscFactorLoads, i
-                )
-
-                self.test_env.store_results(OptResult, i)
-
-                CurrOptState = NextOptState
-
-            if return_output:
-                return self.test_env.res_df
 
-            else:
+                elif test_agent.policy_type == "discrete":
+                    # action = test_agent.action_space.values[dist.sample()]
+                    actions = test_agent.action_space.values[
+                        torch.max(dist.logits, axis=1)[1].cpu().numpy()
+                    ]
+
+                if side_only:
+                    actions = np.array(
+                        [
+                            get_bet_size(
+                                qvalues[k : k + 1],
+                                action,
+                                action_limit=test_agent.action_space.action_range[0],
+                                zero_action=test_agent.action_space.zero_action,
+                                rng=self.rng,
+                            )
+                            for k, action in enumerate(actions)
+                        ]
+                    )
 
-                # select interesting variables and express as a percentage of the GP results
-                pnl_str = list(
-                    filter(lambda x: "NetPNL_{}".format(self.tag) in x, self.variables)
-                )
-                opt_pnl_str = list(filter(lambda x: "OptNetPNL" in x, self.variables))
-                rew_str = list(
-                    filter(lambda x: "Reward_{}".format(self.tag) in x, self.variables)
+                NextStates, Results = self.test_env.step(
+                    CurrStates, actions, i, tag="PPO", MV_res=self.MV_res
                 )
-                opt_rew_str = list(filter(lambda x: "OptReward" in x, self.variables))
-
-                # pnl
-                pnl = self.test_env.res_df[pnl_str + opt_pnl_str].iloc[:-1]
-                cum_pnl = pnl.cumsum()
-
-                if (
-                    data_handler.datatype == "garch"
-                    or data_handler.datatype == "garch_mr"
-                ):
-                    ref_pnl = np.array(cum_pnl[pnl_str]) - np.array(
-                        cum_pnl[opt_pnl_str]
-                    )
-                else:
-                    ref_pnl = (
-                        np.array(cum_pnl[pnl_str]) / np.array(cum_pnl[opt_pnl_str])
-                    ) * 100
-
-                # rewards
-                rew = self.test_env.res_df[rew_str + opt_rew_str].iloc[:-1]
-                cum_rew = rew.cumsum()
-                if (
-                    data_handler.datatype == "garch"
-                    or data_handler.datatype == "garch_mr"
-                ):
-                    ref_rew = np.array(cum_rew[rew_str]) - np.array(
-                        cum_rew[opt_rew_str]
-                    )
-                else:
-                    ref_rew = (
-                        np.array(cum_rew[rew_str]) / np.array(cum_rew[opt_rew_str])
-                    ) * 100
-
-                # SR
-                mean = np.array(pnl[pnl_str]).mean()
-                std = np.array(pnl[pnl_str]).std()
-                sr = (mean / std) * (252 ** 0.5)
-
-                # # Holding
-                # hold = self.test_env.res_df["NextHolding_{}".format(self.tag)].iloc[
-                #     -2
-                # ]  # avoid last observation
-                # opthold = self.test_env.res_df["OptNextHolding"].iloc[-2]
-
-                # pdist_avg = (
-                #     (
-                #         self.test_env.res_df["NextHolding_{}".format(self.tag)].values
-                #         - self.test_env.res_df["OptNextHolding"].values
-                #     )
-                #     ** 2
-                # ).mean()
-
-                opt_mean = np.array(pnl[opt_pnl_str]).mean()
-                opt_std = np.array(pnl[opt_pnl_str]).std()
-                optsr = (opt_mean / opt_std) * (252 ** 0.5)
-
-                perc_SR = (sr / optsr) * 100
-                pnl_std = (std / opt_std) * 100
-                
-                avg_pnls.append(ref_pnl[-1])
-                avg_rews.append(ref_rew[-1])
-                avg_srs.append(perc_SR)
-                abs_pnl_rl.append(cum_pnl.iloc[-1].values[0])
-                abs_pnl_gp.append(cum_pnl.iloc[-1].values[1])
-                abs_rew_rl.append(cum_rew.iloc[-1].values[0])
-                abs_rew_gp.append(cum_rew.iloc[-1].values[1])
-                abs_sr_rl.append(sr)
-                abs_sr_gp.append(optsr)
-                abs_hold_rl.append(0.0)
-                # abs_hold_rl.append(hold)
-                abs_hold_gp.append(0.0)
-                # abs_hold_gp.append(opthold)
-                avg_pnlstd.append(pnl_std)
-                avg_pdist.append(0.0)
-                # avg_pdist.append(pdist_avg)
-
-                if self.test_env.cash:
-                    # Wealth
-                    wealth = self.test_env.res_df["Wealth_{}".format(self.tag)].iloc[:-1]  # avoid last observation
-                    abs_wealth_rl.append(wealth.iloc[-1])
-                    optwealth = self.test_env.res_df["OptWealth"].iloc[:-1] 
-                    abs_wealth_gp.append(optwealth.iloc[-1])
-
-
-        self._collect_results(
-            avg_pnls,
-            avg_rews,
-            avg_srs,
-            abs_pnl_rl,
-            abs_pnl_gp,
-            abs_rew_rl,
-            abs_rew_gp,
-            abs_sr_rl,
-            abs_sr_gp,
-            abs_hold_rl,
-            abs_hold_gp,
-            avg_pnlstd,
-            avg_pdist,
-            it=it,
-            abs_wealthrl=abs_wealth_rl,
-            abs_wealthgp=abs_wealth_gp,
+                self.test_env.store_results(Results, i)
+
+            CurrStates = NextStates
+
+        # the batched results of the agent are copied once to each environment
+        self.test_env.flush_results()
+        # benchmark agent does not depend on the agent actions, so the whole
+        # trajectory is computed and stored in a single pass
+        self.test_env.store_opt_trajectory(n_steps=self.N_test + 1)
+
+        if return_output:
+            return self.test_env.envs[0].res_df
+
+        # (n_seeds, N_test) arrays read straight from the env result stores
+        # (avoid last observation)
+        def stack(key: str) -> np.ndarray:
+            return np.stack([env.results[key][:-1] for env in self.test_env.envs])
+
+        if self.cash:
+            wealth_rl = stack("Wealth_{}".format(self.tag))
+            wealth_gp = stack("OptWealth")
+        else:
+            wealth_rl, wealth_gp = None, None
+
+        values = compute_oos_metrics(
+            stack("NetPNL_{}".format(self.tag)),
+            stack("OptNetPNL"),
+            stack("Reward_{}".format(self.tag)),
+            stack("OptReward"),
+            wealth_rl=wealth_rl,
+            wealth_gp=wealth_gp,
+            relative=datatype != "garch" and datatype != "garch_mr",
         )
+        self._collect_results(values, it=it)
+
+    def submit_test(self, test_agent: object, it: int, agent_kwargs: dict):
+        """
+        Test the agent at the given checkpoint. When n_workers is zero the test
+        runs synchronously, otherwise a snapshot of the weights is handed to a
+        worker process and training can go on while the test is running. The
+        results are merged into the metrics when the test is done or at the
+        latest in save_series.
+
+        Parameters
+        ----------
+        test_agent: object
+            Agent to test
+
+        it: int
+            Checkpoint of the test
+
+        agent_kwargs: dict
+            Arguments used to instantiate the agent, so that the worker can
+            rebuild it before loading the snapshot of the weights
+        """
+        if not self.n_workers:
+            self.run_test(test_agent, it=it)
+            return
+
+        if self._pool is None:
+            # spawned workers do not inherit the TF and torch runtime of the parent
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_test_worker,
+                initargs=(self.worker_threads,),
+            )
 
-    def init_series_to_fill(self, iterations):
-        self.mean_series_pnl = pd.DataFrame(index=range(1), columns=iterations)
-        self.mean_series_rew = pd.DataFrame(index=range(1), columns=iterations)
-        self.mean_series_sr = pd.DataFrame(index=range(1), columns=iterations)
-        self.mean_series_pnl_std = pd.DataFrame(index=range(1), columns=iterations)
-
-        self.abs_series_pnl_rl = pd.DataFrame(index=range(1), columns=iterations)
-        self.abs_series_pnl_gp = pd.DataFrame(index=range(1), columns=iterations)
-
-        self.abs_series_rew_rl = pd.DataFrame(index=range(1), columns=iterations)
-        self.abs_series_rew_gp = pd.DataFrame(index=range(1), columns=iterations)
-
-        self.abs_series_sr_rl = pd.DataFrame(index=range(1), columns=iterations)
-        self.abs_series_sr_gp = pd.DataFrame(index=range(1), columns=iterations)
-
-        self.abs_series_hold_rl = pd.DataFrame(index=range(1), columns=iterations)
-        self.abs_series_hold_gp = pd.DataFrame(index=range(1), columns=iterations)
-
-        self.mean_series_pdist = pd.DataFrame(index=range(1), columns=iterations)
-    
-        self.abs_series_wealth_rl = pd.DataFrame(index=range(1), columns=iterations)
-        self.abs_series_wealth_gp = pd.DataFrame(index=range(1), columns=iterations)
-
-    def _collect_results(
-        self,
-        pnl,
-        rew,
-        sr,
-        abs_prl,
-        abs_pgp,
-        abs_rewrl,
-        abs_rewgp,
-        abs_srrl,
-        abs_srgp,
-        abs_hold,
-        abs_opthold,
-        pnl_std,
-        pdist_avg,
-        it,
-        abs_wealthrl= None,
-        abs_wealthgp= None,
-    ):
-
-        self.mean_series_pnl.loc[0, str(it)] = np.mean(pnl)
-        self.mean_series_rew.loc[0, str(it)] = np.mean(rew)
-        self.mean_series_sr.loc[0, str(it)] = np.mean(sr)
-        self.mean_series_pnl_std.loc[0, str(it)] = np.mean(pnl_std)
-
-        self.abs_series_pnl_rl.loc[0, str(it)] = np.mean(abs_prl)
-        self.abs_series_pnl_gp.loc[0, str(it)] = np.mean(abs_pgp)
-
-        self.abs_series_rew_rl.loc[0, str(it)] = np.mean(abs_rewrl)
-        self.abs_series_rew_gp.loc[0, str(it)] = np.mean(abs_rewgp)
-
-        self.abs_series_sr_rl.loc[0, str(it)] = np.mean(abs_srrl)
-        self.abs_series_sr_gp.loc[0, str(it)] = np.mean(abs_srgp)
-
-        self.abs_series_hold_rl.loc[0, str(it)] = np.mean(abs_hold)
-        self.abs_series_hold_gp.loc[0, str(it)] = np.mean(abs_opthold)
+        tester_kwargs = {
+            "n_seeds": self.n_seeds,
+            "N_test": self.N_test,
+            "rnd_state": self.rnd_state,
+            "savedpath": self.savedpath,
+            "tag": self.tag,
+            "experiment_type": self.experiment_type,
+            "env_cls": self.env_cls,
+            "MV_res": self.MV_res,
+            "cache_dir": self.cache_dir,
+        }
+        self._pending.append(
+            self._pool.submit(
+                _run_test_worker,
+                _config_str(),
+                tester_kwargs,
+                type(test_agent),
+                agent_kwargs,
+                self._snapshot_weights(test_agent),
+                it,
+            )
+        )
+        self._merge_done()
+
+    def wait(self):
+        for future in self._pending:
+            self._merge(future.result())
+        self._pending = []
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _snapshot_weights(self, test_agent: object) -> Union[list or dict]:
+        if self.tag == "DQN":
+            return test_agent.model.get_weights()
+        return {
+            name: value.detach().cpu().clone()
+            for name, value in test_agent.model.state_dict().items()
+        }
+
+    def _merge_done(self):
+        pending = []
+        for future in self._pending:
+            if future.done():
+                self._merge(future.result())
+            else:
+                pending.append(future)
+        self._pending = pending
 
-        self.mean_series_pdist.loc[0, str(it)] = np.mean(pdist_avg)
+    def _merge(self, result: tuple):
+        it, cash, values = result
+        self.cash = cash
+        self._collect_results(values, it=it)
 
-        if abs_wealthrl:
-            self.abs_series_wealth_rl.loc[0, str(it)] = np.mean(abs_wealthrl)
-            self.abs_series_wealth_gp.loc[0, str(it)] = np.mean(abs_wealthgp)
+    def _simulate_test_series(self, n_seeds: int) -> list:
+        self.rng_test = np.random.RandomState(self.rnd_state)
+        series = []
+        for _ in range(n_seeds):
+            data_handler = DataHandler(N_train=self.N_test, rng=self.rng_test)
+            data_handler.generate_returns()
+            if self.experiment_type != "GP":
+                # TODO check if these method really fit and change the parameters in the gin file
+                data_handler.estimate_parameters()
+            series.append(
+                {
+                    "returns": data_handler.returns,
+                    "factors": data_handler.factors,
+                    "f_speed": data_handler.f_speed,
+                }
+            )
+        return series
+
+    def _series_config(self) -> dict:
+        # everything that determines the simulated test series
+        return {
+            "N_test": self.N_test,
+            "rnd_state": self.rnd_state,
+            "n_seeds": self.n_seeds,
+            "DataHandler": gin.get_bindings(DataHandler),
+            "return_sampler_GP": gin.get_bindings("return_sampler_GP"),
+            "alpha_term_structure_sampler": gin.get_bindings(
+                "alpha_term_structure_sampler"
+            ),
+        }
+
+    def _load_test_series(self, n_seeds: int) -> list:
+        config = self._series_config()
+        # fitted parameters are bound into gin and garch series are not seeded
+        # by rnd_state, so those series are always simulated again
+        if (
+            self.experiment_type != "GP"
+            or config["DataHandler"].get("datatype") == "garch"
+        ):
+            return self._simulate_test_series(n_seeds)
+
+        key = SeriesCache.key(config)
+        if key != self._series_key:
+            cache = SeriesCache(self.cache_dir) if self.cache_dir else None
+            stacked = cache.load(key) if cache else None
+            if stacked is None:
+                series = self._simulate_test_series(self.n_seeds)
+                stacked = {
+                    name: np.stack([s[name] for s in series]) for name in series[0]
+                }
+                if cache:
+                    stacked = cache.store(key, stacked)
+            self._series_key, self._series = key, stacked
+
+        return [
+            {name: value[i] for name, value in self._series.items()}
+            for i in range(n_seeds)
+        ]
+
+    def init_series_to_fill(self, iterations: list):
+        # one row per checkpoint and one column per metric in OOS_METRICS
+        self.checkpoints = [str(it) for it in iterations]
+        self.metrics = np.full((len(self.checkpoints), len(OOS_METRICS)), np.nan)
+
+    def metrics_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            self.metrics,
+            index=pd.Index(self.checkpoints, name="checkpoint"),
+            columns=[name for name, _, _ in OOS_METRICS],
+        )
 
+    def _collect_results(self, values: np.ndarray, it: int):
+        if str(it) not in self.checkpoints:
+            self.checkpoints.append(str(it))
+            self.metrics = np.vstack([self.metrics, np.full(len(OOS_METRICS), np.nan)])
+        self.metrics[self.checkpoints.index(str(it))] = values
 
     def save_series(self):
 
-        self.mean_series_pnl.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "NetPnl_OOS_{}_{}.parquet.gzip".format(
-                    format_tousands(self.N_test), self.tag
-                ),
-            ),
-            compression="gzip",
-        )
-        self.mean_series_rew.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "Reward_OOS_{}_{}.parquet.gzip".format(
-                    format_tousands(self.N_test), self.tag
-                ),
-            ),
-            compression="gzip",
-        )
-        self.mean_series_sr.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "SR_OOS_{}_{}.parquet.gzip".format(
-                    format_tousands(self.N_test), self.tag
-                ),
-            ),
-            compression="gzip",
-        )
+        # wait for the outstanding asynchronous tests
+        self.wait()
 
-        self.mean_series_pnl_std.to_parquet(
+        # a single long format table per run, see utils.results
+        table = oos_metrics_table(self.metrics, self.checkpoints, self.tag)
+        table.to_parquet(
             os.path.join(
                 self.savedpath,
-                "PnLstd_OOS_{}_{}.parquet.gzip".format(
-                    format_tousands(self.N_test), self.tag
-                ),
+                OOS_METRICS_FILE.format(format_tousands(self.N_test), self.tag),
             ),
-            compression="gzip",
+            compression="zstd",
+            index=False,
         )
 
-        self.abs_series_pnl_rl.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "AbsNetPnl_OOS_{}_{}.parquet.gzip".format(
-                    format_tousands(self.N_test), self.tag
-                ),
-            ),
-            compression="gzip",
-        )
-        self.abs_series_pnl_gp.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "AbsNetPnl_OOS_{}_GP.parquet.gzip".format(format_tousands(self.N_test)),
-            ),
-            compression="gzip",
-        )
-        self.abs_series_rew_rl.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "AbsRew_OOS_{}_{}.parquet.gzip".format(
-                    format_tousands(self.N_test), self.tag
-                ),
-            ),
-            compression="gzip",
-        )
-        self.abs_series_rew_gp.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "AbsRew_OOS_{}_GP.parquet.gzip".format(format_tousands(self.N_test)),
-            ),
-            compression="gzip",
-        )
-        self.abs_series_sr_rl.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "AbsSR_OOS_{}_{}.parquet.gzip".format(
-                    format_tousands(self.N_test), self.tag
-                ),
-            ),
-            compression="gzip",
-        )
-        self.abs_series_sr_gp.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "AbsSR_OOS_{}_GP.parquet.gzip".format(format_tousands(self.N_test)),
-            ),
-            compression="gzip",
-        )
-        self.abs_series_hold_rl.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "AbsHold_OOS_{}_{}.parquet.gzip".format(
-                    format_tousands(self.N_test), self.tag
-                ),
-            ),
-            compression="gzip",
-        )
-        self.abs_series_hold_gp.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "AbsHold_OOS_{}_GP.parquet.gzip".format(format_tousands(self.N_test)),
-            ),
-            compression="gzip",
-        )
 
-        self.mean_series_pdist.to_parquet(
-            os.path.join(
-                self.savedpath,
-                "Pdist_OOS_{}_GP.parquet.gzip".format(format_tousands(self.N_test)),
-            ),
-            compression="gzip",
-        )
+def compute_oos_metrics(
+    pnl_rl: np.ndarray,
+    pnl_gp: np.ndarray,
+    rew_rl: np.ndarray,
+    rew_gp: np.ndarray,
+    wealth_rl: Optional[np.ndarray] = None,
+    wealth_gp: Optional[np.ndarray] = None,
+    relative: bool = True,
+) -> np.ndarray:
+    """
+    Compute all the out-of-sample metrics of a checkpoint at once, from the
+    series of every test seed stacked along the first axis, and average them
+    over the seeds.
+
+    Parameters
+    ----------
+    pnl_rl: np.ndarray
+        Net PnL of the agent of shape (n_seeds, N_test)
+
+    pnl_gp: np.ndarray
+        Net PnL of the benchmark of shape (n_seeds, N_test)
+
+    rew_rl: np.ndarray
+        Reward of the agent of shape (n_seeds, N_test)
+
+    rew_gp: np.ndarray
+        Reward of the benchmark of shape (n_seeds, N_test)
+
+    wealth_rl: Optional[np.ndarray]
+        Wealth of the agent of shape (n_seeds, N_test), only for cash environments
+
+    wealth_gp: Optional[np.ndarray]
+        Wealth of the benchmark of shape (n_seeds, N_test), only for cash environments
+
+    relative: bool
+        Express cumulative PnL and reward of the agent as a percentage of the
+        benchmark ones instead of as a difference
+
+    Returns
+    -------
+    values: np.ndarray
+        Metrics averaged over the seeds, in the order of OOS_METRICS. Metrics
+        that are not available are NaN
+    """
+    cum_pnl_rl = np.cumsum(pnl_rl, axis=1)[:, -1]
+    cum_pnl_gp = np.cumsum(pnl_gp, axis=1)[:, -1]
+    cum_rew_rl = np.cumsum(rew_rl, axis=1)[:, -1]
+    cum_rew_gp = np.cumsum(rew_gp, axis=1)[:, -1]
+
+    std, opt_std = pnl_rl.std(axis=1), pnl_gp.std(axis=1)
+    sr = (pnl_rl.mean(axis=1) / std) * (252 ** 0.5)
+    optsr = (pnl_gp.mean(axis=1) / opt_std) * (252 ** 0.5)
+
+    metrics = np.full((len(pnl_rl), len(OOS_METRICS)), np.nan)
+    if relative:
+        metrics[:, 0] = (cum_pnl_rl / cum_pnl_gp) * 100
+        metrics[:, 1] = (cum_rew_rl / cum_rew_gp) * 100
+    else:
+        metrics[:, 0] = cum_pnl_rl - cum_pnl_gp
+        metrics[:, 1] = cum_rew_rl - cum_rew_gp
+    metrics[:, 2] = (sr / optsr) * 100
+    metrics[:, 3] = (std / opt_std) * 100
+    metrics[:, 4:10] = np.column_stack(
+        [cum_pnl_rl, cum_pnl_gp, cum_rew_rl, cum_rew_gp, sr, optsr]
+    )
+    # holdings and distance from the benchmark holdings are not tracked
+    metrics[:, 10:13] = 0.0
+    if wealth_rl is not None:
+        metrics[:, 13] = wealth_rl[:, -1]
+        metrics[:, 14] = wealth_gp[:, -1]
+
+    return metrics.mean(axis=0)
+
+
+def _config_str() -> str:
+    # numpy 2 prints scalars as np.float64(x), which gin cannot parse back
+    if np.lib.NumpyVersion(np.__version__) >= "2.0.0":
+        with np.printoptions(legacy="1.25"):
+            return gin.config_str()
+    return gin.config_str()
+
+
+def _init_test_worker(n_threads: int):
+    # avoid oversubscription between the training process and the workers
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(n_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(1)
+
+
+def _run_test_worker(
+    config_str: str,
+    tester_kwargs: dict,
+    agent_cls: object,
+    agent_kwargs: dict,
+    weights: Union[list or dict],
+    it: int,
+) -> tuple:
+    gin.parse_config(config_str, skip_unknown=True)
+
+    test_agent = agent_cls(**agent_kwargs)
+    if isinstance(weights, dict):
+        test_agent.model.load_state_dict(weights)
+    else:
+        # build the keras model before setting its weights
+        input_shape = (1,) + tuple(agent_kwargs["input_shape"])
+        test_agent.model(np.zeros(input_shape, dtype="float32"))
+        test_agent.model.set_weights(weights)
+
+    tester = Out_sample_vs_gp(**tester_kwargs)
+    tester.init_series_to_fill(iterations=[str(it)])
+    tester.run_test(test_agent, it=it)
+
+    return it, tester.cash, tester.metrics[0]
 
-        if self.test_env.cash:
-            self.abs_series_wealth_rl.to_parquet(
-                os.path.join(
-                    self.savedpath,
-                    "AbsWealth_OOS_{}_{}.parquet.gzip".format(
-                        format_tousands(self.N_test), self.tag
-                    ),
-                ),
-                compression="gzip",
-            )
-            self.abs_series_wealth_gp.to_parquet(
-                os.path.join(
-                    self.savedpath,
-                    "AbsWealth_OOS_{}_GP.parquet.gzip".format(format_tousands(self.N_test)),
-                ),
-                compression="gzip",
-            )
@@ -7,7 +7,6 @@ Created on Thu Nov 26 14:38:05 2020
 import pdb
 import sys
 import gin
-from tqdm import tqdm
 import numpy as np
 import tensorflow as tf
 from typing import Union, Tuple
@@ -109,44 +108,27 @@ def get_action_boundaries(
         factors,
     )
 
+    # benchmark actions and holdings over the whole series in one vectorized pass
     if action_type == "GP":
-        CurrOptState = env.opt_reset()
         OptRate, DiscFactorLoads = env.opt_trading_rate_disc_loads()
-
-        cycle_len = len(returns) - 1
-        for i in tqdm(iterable=range(cycle_len), desc="Selecting Action boundaries"):
-            NextOptState, OptResult = env.opt_step(
-                CurrOptState, OptRate, DiscFactorLoads, i
-            )
-            env.store_results(OptResult, i)
-            CurrOptState = NextOptState
-
-        action_quantiles = env.res_df["OptNextAction"].quantile(qts).values
+        Result = env.opt_trajectory(OptRate, DiscFactorLoads)
+        actions, holdings = Result["OptNextAction"], Result["OptNextHolding"]
     elif action_type == "MV":
-        CurrMVState = env.opt_reset()
-
-        cycle_len = len(returns) - 1
-        for i in tqdm(iterable=range(cycle_len), desc="Selecting Action boundaries"):
-            NextMVState, MVResult = env.mv_step(CurrMVState, i)
-            env.store_results(MVResult, i)
-            CurrMVState = NextMVState
-
-        action_quantiles = env.res_df["MVNextAction"].quantile(qts).values
-
+        Result = env.mv_trajectory()
+        actions, holdings = Result["MVNextAction"], Result["MVNextHolding"]
     else:
         print("Choose proper action type. Please, read the doc.")
         sys.exit()
 
+    action_quantiles = np.quantile(actions, qts)
+
     qt = np.min(np.abs(action_quantiles))
     length = len(str(int(np.round(qt))))
     action_range = int(np.abs(np.round(qt, -length + 1)))
 
     ret_range = float(max(np.abs(returns.min()), returns.max()))
 
-    if action_type == "GP":
-        holding_quantiles = env.res_df["OptNextHolding"].quantile(qts).values
-    elif action_type == "MV":
-        holding_quantiles = env.res_df["MVNextHolding"].quantile(qts).values
+    holding_quantiles = np.quantile(holdings, qts)
 
     if np.abs(holding_quantiles[0]) - np.abs(holding_quantiles[1]) < 1000:
         holding_ranges = int(np.abs(np.round(holding_quantiles[0], -2)))
@@ -324,7 +306,7 @@ def get_bet_size(
 
     """
     # when qvalues are not provided because the action is taked at random
-    if qvalues == None:
+    if qvalues is None:
         if side_action == 0.0:
             m = 0
         elif side_action == -1.0: